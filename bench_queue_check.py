@@ -0,0 +1,256 @@
+"""
+Benchmarks queue_check.py's parsing, evaluation, state save/load, and email-building,
+  against synthetic `rqinfo --by-queue --raw` output, at several scales;
+  and its cold-start import time, via `python -X importtime`.
+
+Usage:
+% cd /path/to/queue_checker/
+% python ./bench_queue_check.py                              # scales 10, 1000, 100000; json to stdout
+% python ./bench_queue_check.py --scales 10,1000 --output ../bench_results.json
+% python ./bench_queue_check.py --startup-only                 # just the import-time benchmark
+
+Results are json, so runs from different versions can be compared.
+"""
+
+import argparse, datetime, json, os, platform, random, statistics, subprocess, sys, tempfile, time
+
+## queue_check reads these on import; the benchmarks don't depend on their values.
+os.environ.setdefault( 'QCHKR__LOG_LEVEL', 'INFO' )
+os.environ.setdefault( 'QCHKR__EXPECTATIONS_JSON', '{}' )
+
+import queue_check
+
+
+EXPECTED_QUEUES_CAP = 1000  # expectations are hand-written config; even large installations list hundreds, not 100k
+DEFAULT_SCALES = '10,1000,100000'
+IMPORT_REPEAT = 15
+IMPORT_TOP_MODULES = 10
+
+
+## main controller --------------------------------------------------
+
+
+def run_benchmarks( scales, seed=0, startup_only=False ):
+    """ Runs the import-time benchmark, then every other benchmark at every scale; returns a json-serializable report.
+        Called by dunder-main. """
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'git_commit': get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': [ time_import_benchmark(IMPORT_REPEAT) ] }
+    if startup_only:
+        return report
+    for scale in scales:
+        rng = random.Random( seed )
+        rq_output = generate_rqinfo_output( queue_count=scale, worker_count=scale, rng=rng )
+        data_dct = queue_check.parse_rqinfo( rq_output )
+        bench_expectations = build_expectations( data_dct )
+        previous_failed_count = max( 0, data_dct['failed_count'] - 5 )
+        evaluation_dct = queue_check.evaluate_qdata( previous_failed_count, bench_expectations, data_dct )
+        repeat = repeat_count_for( scale )
+        benchmarks = {
+            'parse_rqinfo': lambda: queue_check.parse_rqinfo( rq_output ),
+            'parse_rqinfo_lines': lambda: queue_check.parse_rqinfo_lines( iter(rq_output.splitlines(keepends=True)) ),
+            'evaluate_qdata': lambda: queue_check.evaluate_qdata( previous_failed_count, bench_expectations, data_dct ),
+            'build_email_message': lambda: queue_check.build_email_message( previous_failed_count, bench_expectations, evaluation_dct, data_dct ),
+            }
+        for ( name, func ) in benchmarks.items():
+            result = time_benchmark( name, scale, func, repeat )
+            result['rqinfo_output_bytes'] = len( rq_output.encode('utf-8') )
+            report['results'].append( result )
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for state_format in ( 'json', 'binary' ):
+                report['results'].extend( time_state_benchmarks(data_dct, state_format, temp_dir, scale, repeat) )
+    return report
+
+
+## synthetic data ---------------------------------------------------
+
+
+def generate_rqinfo_output( queue_count, worker_count, rng ):
+    """
+    Returns realistic `rqinfo --by-queue --raw` output: `queue <name> <count>` lines (including the `failed` queue),
+      then one `<name>: <worker> (<state>), ...` line per queue, padded like rqinfo pads them,
+      with an en-dash for queues that have no workers.
+    Each worker listens on one or two queues; about a tenth of the queues have no workers.
+    Called by run_benchmarks()
+
+    >>> print( generate_rqinfo_output(3, 2, random.Random(0)) )
+    queue queue_0000000 25
+    queue queue_0000001 50
+    queue failed 424
+    queue_0000000: server.1000 (busy)
+    queue_0000001: server.1001 (busy)
+    failed:        –
+    <BLANKLINE>
+    """
+    queue_names = [ f'queue_{index:07d}' for index in range(max(0, queue_count - 1)) ] + [ 'failed' ]
+    workable_queue_names = queue_names[:-1] or queue_names
+    staffed_queue_names = [ name for (index, name) in enumerate(workable_queue_names) if index % 10 != 9 ] or workable_queue_names
+    workers_by_queue = { name: [] for name in queue_names }
+    for worker_index in range( worker_count ):
+        worker_entry = f'server.{1000 + worker_index} ({rng.choice(["idle", "busy"])})'
+        first_queue = staffed_queue_names[ worker_index % len(staffed_queue_names) ]
+        workers_by_queue[first_queue].append( worker_entry )
+        if rng.random() < 0.2:
+            second_queue = rng.choice( staffed_queue_names )
+            if second_queue != first_queue:
+                workers_by_queue[second_queue].append( worker_entry )
+    pad_width = max( len(name) for name in queue_names ) + 1
+    lines = []
+    for name in queue_names:
+        count = rng.randint( 0, 500 ) if name == 'failed' else rng.randint( 0, 50 )
+        lines.append( f'queue {name} {count}' )
+    for name in queue_names:
+        workers_str = ', '.join( sorted(workers_by_queue[name]) ) or '–'
+        lines.append( f'{(name + ":").ljust(pad_width)} {workers_str}' )
+    return '\n'.join( lines ) + '\n'
+
+
+def build_expectations( data_dct ):
+    """ Returns expectations matching the data, spread across the whole queue-list so lookups don't all hit its start.
+        Called by run_benchmarks() """
+    queue_names = data_dct['queues']
+    step = max( 1, len(queue_names) // EXPECTED_QUEUES_CAP )
+    expected_queues = queue_names[::step][:EXPECTED_QUEUES_CAP]
+    expected_workers = [
+        {'queue': name, 'worker_count': len(data_dct['workers_by_queue'].get(name, []))} for name in expected_queues ]
+    return { 'expected_queues': expected_queues, 'expected_workers': expected_workers, 'surge_failure_limit': 10 }
+
+
+## timing -----------------------------------------------------------
+
+
+def repeat_count_for( scale ):
+    """ Returns how many timed repetitions to run; fewer for larger scales.
+        Called by run_benchmarks()
+    >>> [ repeat_count_for(scale) for scale in (10, 1000, 100000) ]
+    [200, 20, 3]
+    """
+    if scale <= 100:
+        return 200
+    if scale <= 10000:
+        return 20
+    return 3
+
+
+def time_benchmark( name, scale, func, repeat ):
+    """ Times `func` `repeat` times; returns a result dict.
+        Called by run_benchmarks() and time_state_benchmarks() """
+    durations = []
+    for _ in range( repeat ):
+        start_time = time.perf_counter()
+        func()
+        durations.append( time.perf_counter() - start_time )
+    result = {
+        'benchmark': name,
+        'scale': scale,
+        'repeat': repeat,
+        'best_seconds': min( durations ),
+        'median_seconds': statistics.median( durations ),
+        'mean_seconds': statistics.fmean( durations ) }
+    print( f'{name:>28} scale={scale:<8} best={result["best_seconds"] * 1000:10.3f}ms', file=sys.stderr )
+    return result
+
+
+def time_state_benchmarks( data_dct, state_format, temp_dir, scale, repeat ):
+    """ Times save_rqinfo_data() and load_previous_rqinfo_data() for one state-format; returns result dicts.
+        Called by run_benchmarks() """
+    file_path = os.path.join( temp_dir, f'state_{state_format}.dat' )
+    original_format = queue_check.STATE_FORMAT
+    queue_check.STATE_FORMAT = state_format
+    try:
+        save_result = time_benchmark( f'save_rqinfo_data_{state_format}', scale, lambda: queue_check.save_rqinfo_data(data_dct, file_path), repeat )
+        save_result['state_bytes'] = os.path.getsize( file_path )
+        load_result = time_benchmark( f'load_previous_rqinfo_data_{state_format}', scale, lambda: queue_check.load_previous_rqinfo_data(data_dct, file_path), repeat )
+    finally:
+        queue_check.STATE_FORMAT = original_format
+    return [ save_result, load_result ]
+
+
+def time_import_benchmark( repeat ):
+    """ Times `import queue_check` in fresh interpreters, with `-X importtime`; returns a result dict,
+          including the modules with the largest cumulative import-times, from the fastest run.
+        Called by run_benchmarks() """
+    runs = []
+    for _ in range( repeat ):
+        output = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import queue_check'],
+            stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)), check=True )
+        runs.append( parse_importtime_output(output.stderr.decode('utf-8')) )
+    durations = [ run['queue_check'] / 1_000_000 for run in runs ]
+    fastest_run = runs[ durations.index(min(durations)) ]
+    top_modules = sorted( ( (name, microseconds) for (name, microseconds) in fastest_run.items() if name != 'queue_check' ), key=lambda item: -item[1] )
+    result = {
+        'benchmark': 'import_queue_check',
+        'scale': None,
+        'repeat': repeat,
+        'best_seconds': min( durations ),
+        'median_seconds': statistics.median( durations ),
+        'mean_seconds': statistics.fmean( durations ),
+        'top_imports_microseconds': dict( top_modules[:IMPORT_TOP_MODULES] ) }
+    print( f'{"import_queue_check":>28} {"":<14} best={result["best_seconds"] * 1000:10.3f}ms', file=sys.stderr )
+    return result
+
+
+def parse_importtime_output( text ):
+    """ Returns { module: cumulative-microseconds } for queue_check and the modules it imports directly;
+          nested imports are counted within their importer, and the interpreter's own start-up imports are skipped.
+        Called by time_import_benchmark()
+    >>> lines = [
+    ...     'import time: self [us] | cumulative | imported package',
+    ...     'import time:        50 |         50 |   os',
+    ...     'import time:       500 |        550 | site',
+    ...     'import time:       100 |        100 |     json.decoder',
+    ...     'import time:       200 |        300 |   json',
+    ...     'import time:       400 |        400 |   smtplib',
+    ...     'import time:      1000 |       1700 | queue_check' ]
+    >>> parse_importtime_output( chr(10).join(lines) )
+    {'json': 300, 'smtplib': 400, 'queue_check': 1700}
+    """
+    modules = {}
+    for line in text.splitlines():
+        if not line.startswith( 'import time:' ) or 'cumulative' in line:
+            continue
+        ( _, cumulative, name ) = line[len('import time:'):].split( '|' )
+        indent = len( name ) - len( name.lstrip() )
+        if indent == 3:  # a direct import of the top-level import that follows it
+            modules[name.strip()] = int( cumulative )
+        elif indent == 1:  # a top-level import, listed after its own imports
+            if name.strip() == 'queue_check':
+                modules['queue_check'] = int( cumulative )
+                return modules
+            modules = {}
+    return modules
+
+
+def get_git_commit():
+    """ Returns the current git commit-hash, or None outside a git checkout.
+        Called by run_benchmarks() """
+    try:
+        output = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)) )
+        commit = output.stdout.decode().strip() or None
+    except Exception:
+        commit = None
+    return commit
+
+
+## dunder-main ------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description='Benchmarks queue_check.py against synthetic rqinfo output.' )
+    parser.add_argument( '--scales', default=DEFAULT_SCALES, help=f'comma-separated queue/worker counts (default {DEFAULT_SCALES})' )
+    parser.add_argument( '--seed', type=int, default=0, help='random seed for the synthetic data (default 0)' )
+    parser.add_argument( '--output', default='', help='write the json report here instead of to stdout' )
+    parser.add_argument( '--startup-only', action='store_true', help='only run the import-time benchmark' )
+    args = parser.parse_args()
+    scales = [ int(scale) for scale in args.scales.split(',') ]
+    report = run_benchmarks( scales, seed=args.seed, startup_only=args.startup_only )
+    jsn = json.dumps( report, indent=2 )
+    if args.output:
+        with open( args.output, 'w' ) as f:
+            f.write( jsn )
+    else:
+        print( jsn )
@@ -10,14 +10,23 @@ Usage:
 % source ../venv_settings/env_settings.sh   # for access to settings
 % python ./queue_check.py
 
+Daemon usage (checks every 30 seconds; SIGHUP reloads expectations, SIGTERM stops):
+% python ./queue_check.py --daemon --interval 30
+
+Exporter usage (daemon mode, plus prometheus metrics at http://127.0.0.1:9478/metrics):
+% python ./queue_check.py --exporter --interval 30
+
 Tests can be run via substituting for the above line:
 % python -m doctest ./queue_check.py
 (which will show no output if all tests pass) ...or...
 % python -m doctest -v ./queue_check.py
 """
 
-import datetime, json, logging, os, pprint, smtplib, socket, subprocess
-from email.mime.text import MIMEText
+import datetime, io, json, logging, marshal, math, os, random, re, sqlite3, tempfile, threading, time, zlib
+from contextlib import closing, contextmanager
+from queue import Empty, Queue
+## Modules only some runs need -- alert-mail (smtplib, email), the exporter (http.server), profiling, fleet mode, the cli,
+##   and pretty-printing for debug-logs and alert-mail -- are imported where they're used, to keep cron start-up fast.
 
 
 ENV_LOG_LEVEL = os.environ['QCHKR__LOG_LEVEL']
@@ -29,8 +38,36 @@ logging.basicConfig(  # no file-logging for now
 log = logging.getLogger( '__name__' )
 
 
-expectations: dict = json.loads( os.environ['QCHKR__EXPECTATIONS_JSON'] )
-log.debug( f'expectations, ``{pprint.pformat(expectations)}``' )    
+def load_expectations() -> dict:
+    """ Loads expectations from the json-file at `QCHKR__EXPECTATIONS_PATH` if that envar is set, otherwise from `QCHKR__EXPECTATIONS_JSON`.
+        - The file-option allows a daemon to pick up changed expectations on SIGHUP.
+        Called on module-load, and by reload_expectations() """
+    expectations_path = os.environ.get( 'QCHKR__EXPECTATIONS_PATH', '' )
+    if expectations_path:
+        with open( expectations_path, 'r' ) as f:
+            loaded_expectations = json.loads( f.read() )
+    else:
+        loaded_expectations = json.loads( os.environ['QCHKR__EXPECTATIONS_JSON'] )
+    assert type(loaded_expectations) == dict
+    if log.isEnabledFor( logging.DEBUG ):  # skips the pretty-printing when it wouldn't be logged
+        import pprint
+        log.debug( f'expectations, ``{pprint.pformat(loaded_expectations)}``' )
+    return loaded_expectations
+
+
+expectations: dict = load_expectations()
+
+STATE_DIR_PATH = os.environ.get( 'QCHKR__STATE_DIR', '../previous_rqinfo_data' )
+STATE_FILE_PATH = f'{STATE_DIR_PATH}/previous_rqinfo_data.json'
+STATE_FORMAT = os.environ.get( 'QCHKR__STATE_FORMAT', 'json' )   # 'json' (compact) or 'binary' (marshal)
+STATE_FSYNC = os.environ.get( 'QCHKR__STATE_FSYNC', 'true' ).lower() == 'true'
+OUTBOX_DB_PATH = f'{STATE_DIR_PATH}/alert_outbox.sqlite3'
+HISTORY_DB_FILENAME = 'rqinfo_history.sqlite3'  # kept in the same directory as the state-file
+HISTORY_RETENTION_DAYS = float( os.environ.get('QCHKR__HISTORY_RETENTION_DAYS', '90') )
+HISTORY_DOWNSAMPLE_AFTER_DAYS = float( os.environ.get('QCHKR__HISTORY_DOWNSAMPLE_AFTER_DAYS', '7') )
+HISTORY_DOWNSAMPLE_SECONDS = int( os.environ.get('QCHKR__HISTORY_DOWNSAMPLE_SECONDS', '3600') )
+OK_EVALUATION = {'queue_check': 'ok', 'worker_check': 'ok', 'failure_queue_check': 'ok'}
+PROFILE_MODE = os.environ.get( 'QCHKR__PROFILE', '' )  # '', 'cprofile', or 'tracemalloc'
 
 
 ## main controller --------------------------------------------------
@@ -39,55 +76,671 @@ log.debug( f'expectations, ``{pprint.pformat(expectations)}``' )
 def run_code():
     """
     Controller.
-    Called by dunder-main.
-    """
-    # previous_rqinfo_data = load_previous_rqinfo_data()
-    # assert type(previous_rqinfo_data) == dict
-    ## run `rqinfo` -------------------------------------------------
-    output  = get_rqinfo()
-    assert type(output) == str
-    ## parse `rqinfo` output ----------------------------------------
-    data_dct = parse_rqinfo( output )
+    Returns the list of check-results (one per host) for callers that publish them, like the exporter.
+    Called by dunder-main, and by run_daemon().
+    """
+    with run_instrumentation():
+        results = run_checks()
+    return results
+
+
+def run_checks():
+    """ Runs the single-host or fleet check, and sends any alert.
+        Called by run_code() """
+    ## fleet mode: many redis hosts, checked concurrently -----------
+    if 'hosts' in expectations:
+        results = collect_fleet_results( expectations, STATE_DIR_PATH )
+        send_alerts( results, expectations )
+        log.info( f'fleet evaluations, ``{ {result["host"]: result["evaluation_dct"] for result in results} }``' )
+        return results
+    ## get `rqinfo` data (direct from redis, or via `rqinfo`) -------
+    with timed_stage( 'collect' ):
+        data_dct = get_rqinfo_data()
+    assert type(data_dct) == dict
+    ## load previous data, save current data, evaluate --------------
+    import socket
+    redis_url = os.environ.get( 'QCHKR__REDIS_URL', '' )
+    redis_conn = get_redis_connection( redis_url ) if redis_url else None  # for the failed-job analysis
+    check_result = check_rqinfo_data( socket.gethostname(), data_dct, expectations, STATE_FILE_PATH, redis_conn )
+    check_result['expectations'] = expectations
+    ## send email if an alert started, resolved, or is due a reminder
+    send_alerts( [check_result], expectations )
+    log.info( f'evaluation_dct, ``{check_result["evaluation_dct"]}``' )
+    return [ check_result ]
+
+
+def send_alerts( results, expectations_dct ):
+    """ Sends an email for the check-results' notifications, if there are any:
+        - in digest mode (`digest_seconds` set in expectations), notifications are batched into a digest;
+            a long-running daemon collects them over the digest-window, otherwise the digest covers just this run.
+        - otherwise, a single host gets the standard message, and a fleet gets one combined message.
+        When nothing is sent, messages left in the outbox by an earlier failed run are re-tried.
+        Called by run_checks() """
+    if expectations_dct.get( 'digest_seconds', 0 ):
+        add_to_digest( results )
+        if not alert_digest['windowed']:
+            sent = flush_digest( force=True )
+        else:
+            sent = flush_digest( force=False, digest_seconds=expectations_dct['digest_seconds'] )
+        if not sent:
+            retry_pending_email()
+        return
+    if not any( result['notifications'] for result in results ):
+        retry_pending_email()
+        return
+    with timed_stage( 'email_build' ):
+        if 'hosts' in expectations_dct:
+            msg: str = build_fleet_email_message( results )
+        else:
+            result = results[0]
+            msg: str = build_email_message(
+                result['previous_failed_count'], expectations_dct, result['evaluation_dct'], result['data_dct'], result['violations'], result['notifications'], result['queue_rates'],
+                result.get('failure_groups') )
+    with timed_stage( 'email_send' ):
+        deliver_alert( message=msg )
+    return
+
+
+def check_rqinfo_data( host_name, data_dct, expectations_dct, state_file_path, redis_conn=None ):
+    """ Loads the previous data, saves the current data, appends it to the history, evaluates it against expectations,
+          and updates the alert-states.
+        With a redis connection, also groups the jobs that failed since the previous check.
+        Returns a check-result dict.
+        Called by run_checks() and by check_fleet_host() """
     assert type(data_dct) == dict
+    sample_ts = int( time.time() )
     ## load previous `rqinfo` data ----------------------------------
-    previous_rqinfo_data = load_previous_rqinfo_data( data_dct )
+    with timed_stage( 'state_load' ):
+        previous_rqinfo_data = load_previous_rqinfo_data( data_dct, state_file_path )
     assert type(previous_rqinfo_data) == dict
+    ## analyze newly failed jobs ------------------------------------
+    failure_groups = None
+    if redis_conn is not None:
+        with timed_stage( 'failed_jobs' ):
+            failure_groups = analyze_new_failed_jobs( redis_conn, previous_rqinfo_data, data_dct )
     ## save current `rqinfo` data -----------------------------------
-    save_rqinfo_data( data_dct )
+    with timed_stage( 'state_save' ):
+        save_rqinfo_data( data_dct, state_file_path )
+    ## append to history; compute queue growth-rates and trends -----
+    history_db_path = os.path.join( os.path.dirname(state_file_path), HISTORY_DB_FILENAME )
+    with timed_stage( 'history' ), closing( open_history(history_db_path) ) as history_conn:
+        previous_queue_sample = get_previous_queue_sample( history_conn, host_name, sample_ts )
+        previous_sample = get_history_sample_at( history_conn, host_name, sample_ts - 1 )
+        append_history_sample( history_conn, host_name, data_dct, sample_ts )
+        update_queue_sketches( history_conn, host_name, data_dct, sample_ts )
+        prune_history( history_conn, sample_ts )
+        queue_job_counts = compute_queue_job_counts( previous_rqinfo_data.get('workers'), data_dct.get('workers') )
+        drained_counts = get_drained_counts( queue_job_counts, data_dct.get('workers') )
+        queue_rates = compute_queue_rates( previous_queue_sample, data_dct.get('queue_lengths', {}), sample_ts, drained_counts )
+        failure_baseline = update_failure_baseline( history_conn, host_name, previous_sample, data_dct['failed_count'], sample_ts, expectations_dct )
+        queue_utilization = compute_queue_utilization( data_dct )
+        queue_trends = compute_queue_trends(
+            history_conn, host_name, expectations_dct, data_dct.get('queue_lengths', {}), queue_rates, sample_ts, queue_utilization )
+    for ( queue_name, job_counts ) in queue_job_counts.items():
+        queue_trends.setdefault( queue_name, {} ).update( job_counts )
     ## evaluate `rqinfo` output -------------------------------------
     last_failed_count = previous_rqinfo_data['failed_count']
-    evaluation_dct = evaluate_qdata( last_failed_count, expectations, data_dct )
+    with timed_stage( 'evaluate' ):
+        violations = list_violations( last_failed_count, expectations_dct, data_dct, queue_trends, failure_baseline )
+        evaluation_dct = summarize_violations( violations, expectations_dct )
     assert type(evaluation_dct) == dict
-    if evaluation_dct == {'queue_check': 'ok', 'worker_check': 'ok', 'failure_queue_check': 'ok'}:
-        pass
-    ## send email if necessary ---------------------------------------
-    else:
-        previous_failure_count = previous_rqinfo_data['failed_count']
-        msg: str = build_email_message( previous_failure_count, expectations, evaluation_dct, data_dct )       
-        send_email( message=msg )
-    log.info( f'evaluation_dct, ``{pprint.pformat(evaluation_dct)}``' )
-    return 
+    ## update alert-states ------------------------------------------
+    notifications = track_alerts( host_name, violations, expectations_dct, state_file_path, sample_ts )
+    check_result = {
+        'host': host_name,
+        'data_dct': data_dct,
+        'evaluation_dct': evaluation_dct,
+        'violations': violations,
+        'notifications': notifications,
+        'queue_rates': queue_rates,
+        'queue_utilization': queue_utilization,
+        'queue_job_counts': queue_job_counts,
+        'failure_groups': failure_groups,
+        'previous_failed_count': last_failed_count,
+        'sample_ts': sample_ts }
+    return check_result
+
+
+## instrumentation --------------------------------------------------
+##
+## Each stage of a check is wrapped in timed_stage(); run_instrumentation() logs a per-run summary,
+##   and folds the run into cumulative histograms (useful in daemon and exporter modes).
+## Fleet hosts are checked on threads, so a stage's per-run figure is its total across hosts.
+
+STAGE_HISTOGRAM_BOUNDS = ( 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0 )
+
+stage_timings_lock = threading.Lock()
+run_stage_timings: dict = {}    # stage -> seconds, for the current run
+stage_histograms: dict = {}     # stage -> {'bucket_counts': [...], 'count': n, 'sum': seconds}, across runs
+
+
+@contextmanager
+def timed_stage( stage_name ):
+    """ Adds the wrapped block's elapsed time to the current run's timing for `stage_name`.
+        Called around each stage by run_checks(), check_rqinfo_data(), and the fleet functions.
+    >>> run_stage_timings.clear()
+    >>> with timed_stage( 'example' ):
+    ...     pass
+    >>> sorted( run_stage_timings )
+    ['example']
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start_time
+        with stage_timings_lock:
+            run_stage_timings[stage_name] = run_stage_timings.get( stage_name, 0.0 ) + elapsed
+    return
+
+
+@contextmanager
+def run_instrumentation():
+    """ Resets the per-run stage timings; optionally profiles the run (`QCHKR__PROFILE`); logs a timing summary afterwards.
+        Called by run_code() """
+    with stage_timings_lock:
+        run_stage_timings.clear()
+    profiler = start_profiler( PROFILE_MODE )
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        total_elapsed = time.perf_counter() - start_time
+        stop_profiler( PROFILE_MODE, profiler )
+        with stage_timings_lock:
+            timings = dict( run_stage_timings )
+        timings['total'] = total_elapsed
+        record_stage_histograms( timings )
+        summary = ', '.join( f'{stage} {seconds * 1000:.1f}ms' for (stage, seconds) in timings.items() )
+        log.info( f'stage timings, ``{summary}``' )
+    return
+
+
+def record_stage_histograms( timings ):
+    """
+    Folds one run's stage timings into the cumulative histograms.
+    Called by run_instrumentation()
+
+    >>> stage_histograms.clear()
+    >>> record_stage_histograms( {'collect': 0.02} )
+    >>> record_stage_histograms( {'collect': 2.5} )
+    >>> stage_histograms['collect']['bucket_counts']  # per-bucket, not cumulative; last is the overflow bucket
+    [0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0]
+    >>> print( render_stage_histograms() )  # doctest: +ELLIPSIS
+    # HELP qchkr_stage_duration_seconds Time spent in each stage of a check.
+    # TYPE qchkr_stage_duration_seconds histogram
+    qchkr_stage_duration_seconds_bucket{stage="collect",le="0.001"} 0
+    ...
+    qchkr_stage_duration_seconds_bucket{stage="collect",le="0.05"} 1
+    ...
+    qchkr_stage_duration_seconds_bucket{stage="collect",le="+Inf"} 2
+    qchkr_stage_duration_seconds_sum{stage="collect"} 2.52
+    qchkr_stage_duration_seconds_count{stage="collect"} 2
+    <BLANKLINE>
+    >>> stage_histograms.clear()
+    """
+    with stage_timings_lock:
+        for ( stage_name, seconds ) in timings.items():
+            histogram = stage_histograms.setdefault(
+                stage_name, {'bucket_counts': [0] * (len(STAGE_HISTOGRAM_BOUNDS) + 1), 'count': 0, 'sum': 0.0} )
+            bucket_index = len( STAGE_HISTOGRAM_BOUNDS )
+            for ( index, bound ) in enumerate( STAGE_HISTOGRAM_BOUNDS ):
+                if seconds <= bound:
+                    bucket_index = index
+                    break
+            histogram['bucket_counts'][bucket_index] += 1
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+    return
+
+
+def render_stage_histograms():
+    """ Renders the cumulative stage histograms as prometheus text-format.
+        Called by update_exporter_metrics() """
+    lines = [
+        '# HELP qchkr_stage_duration_seconds Time spent in each stage of a check.',
+        '# TYPE qchkr_stage_duration_seconds histogram' ]
+    with stage_timings_lock:
+        for ( stage_name, histogram ) in stage_histograms.items():
+            running_count = 0
+            bounds = [ str(bound) for bound in STAGE_HISTOGRAM_BOUNDS ] + [ '+Inf' ]
+            for ( bound, bucket_count ) in zip( bounds, histogram['bucket_counts'] ):
+                running_count += bucket_count
+                lines.append( f'qchkr_stage_duration_seconds_bucket{{stage="{stage_name}",le="{bound}"}} {running_count}' )
+            lines.append( f'qchkr_stage_duration_seconds_sum{{stage="{stage_name}"}} {round(histogram["sum"], 6)}' )
+            lines.append( f'qchkr_stage_duration_seconds_count{{stage="{stage_name}"}} {histogram["count"]}' )
+    return '\n'.join( lines ) + '\n'
+
+
+def start_profiler( profile_mode ):
+    """ Starts cProfile or tracemalloc if `profile_mode` asks for it; returns the profiler (or None).
+        Called by run_instrumentation() """
+    profiler = None
+    if profile_mode == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile_mode == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start()
+    return profiler
+
+
+def stop_profiler( profile_mode, profiler ):
+    """ Stops profiling, and logs the results:
+        - cprofile: the top functions by cumulative time; full stats are also dumped to a `.pstats` file in the state-directory.
+        - tracemalloc: peak traced memory, and the top allocation sites.
+        Called by run_instrumentation() """
+    if profile_mode == 'cprofile':
+        import pstats
+        profiler.disable()
+        stats_path = f'{STATE_DIR_PATH}/profile-{int(time.time())}.pstats'
+        os.makedirs( STATE_DIR_PATH, exist_ok=True )
+        profiler.dump_stats( stats_path )
+        stats_output = io.StringIO()
+        pstats.Stats( profiler, stream=stats_output ).sort_stats( 'cumulative' ).print_stats( 20 )
+        log.info( f'cprofile stats (full stats at ``{stats_path}``), ``{stats_output.getvalue()}``' )
+    elif profile_mode == 'tracemalloc':
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot()
+        ( _, peak ) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        top_stats = '\n'.join( str(stat) for stat in snapshot.statistics('lineno')[:10] )
+        log.info( f'tracemalloc peak, ``{peak / 1024:.1f} KiB``; top allocations, ``{top_stats}``' )
+    return
+
+
+## daemon mode ----------------------------------------------------
+
+
+def run_daemon( interval, after_check=None ):
+    """
+    Long-running alternative to cron; calls run_code() every `interval` seconds on a drift-free schedule.
+    - Expectations, logging-setup and redis-connections are set up once and reused.
+    - SIGHUP reloads expectations; SIGTERM or SIGINT stops after the current check.
+    - An exception in one check is logged, and checking continues.
+    - If given, `after_check` is called with each successful check's results.
+    - Alerts are sent by a background mail-sender, so a slow mail-relay doesn't delay the schedule.
+    Called by dunder-main, and by run_exporter().
+    """
+    import pprint, signal
+    assert interval > 0, interval
+    stop_event = threading.Event()
+    reload_event = threading.Event()
+    signal.signal( signal.SIGTERM, lambda signum, frame: stop_event.set() )
+    signal.signal( signal.SIGINT, lambda signum, frame: stop_event.set() )
+    signal.signal( signal.SIGHUP, lambda signum, frame: reload_event.set() )
+    log.info( f'daemon starting; interval, ``{interval}`` seconds' )
+    start_mail_sender()
+    alert_digest['windowed'] = True
+    start_time = time.monotonic()
+    while not stop_event.is_set():
+        if reload_event.is_set():
+            reload_event.clear()
+            reload_expectations()
+        try:
+            results = run_code()
+            if after_check:
+                after_check( results )
+        except Exception:
+            log.exception( 'problem running check; traceback follows; will continue' )
+        next_run_time = compute_next_run_time( start_time, interval, time.monotonic() )
+        stop_event.wait( max(0, next_run_time - time.monotonic()) )
+    try:
+        flush_digest( force=True )
+    except Exception:
+        log.exception( 'problem sending final digest; traceback follows' )
+    stop_mail_sender()
+    log.info( f'daemon stopping; stage-duration histograms, ``{pprint.pformat(stage_histograms)}``' )
+    return
+
+
+def compute_next_run_time( start_time, interval, now ):
+    """
+    Returns the first scheduled time, `start_time + k * interval`, after `now`.
+    Scheduling against the start-time (rather than sleeping `interval` after each check) keeps the schedule from drifting;
+      a check that overruns one or more ticks skips them rather than queueing them up.
+    Called by run_daemon()
+
+    >>> compute_next_run_time( 100.0, 10, 100.0 )
+    110.0
+    >>> compute_next_run_time( 100.0, 10, 103.7 )
+    110.0
+    >>> compute_next_run_time( 100.0, 10, 125.2 )  # a slow check overran a tick
+    130.0
+    """
+    elapsed_ticks = int( (now - start_time) // interval )
+    return start_time + ( (elapsed_ticks + 1) * interval )
+
+
+def reload_expectations():
+    """ Replaces the module-level expectations with freshly-loaded ones; on failure, keeps the current ones.
+        Called by run_daemon() on SIGHUP. """
+    global expectations
+    try:
+        expectations = load_expectations()
+        log.info( 'expectations reloaded' )
+    except Exception:
+        log.exception( 'problem reloading expectations; keeping current expectations; traceback follows' )
+    return
+
+
+## metrics exporter -----------------------------------------------
+##
+## Serves the latest check-results as prometheus/openmetrics text.
+## Checks run on the daemon schedule in the main thread; the http-server thread only ever reads the last-rendered text,
+##   so a scrape never waits on redis or `rqinfo`.
+
+exporter_state: dict = { 'metrics_text': b'# no check has completed yet\n' }
+
+
+def run_exporter( interval, bind_address, port ):
+    """ Starts the metrics http-server on a background thread, then runs the daemon loop, re-rendering metrics after each check.
+        Alerting continues as in daemon mode.
+        Called by dunder-main. """
+    import http.server
+    server = http.server.ThreadingHTTPServer( (bind_address, port), get_metrics_request_handler() )
+    server_thread = threading.Thread( target=server.serve_forever, name='metrics-server', daemon=True )
+    server_thread.start()
+    log.info( f'serving metrics at ``http://{bind_address}:{port}/metrics``' )
+    try:
+        run_daemon( interval, after_check=update_exporter_metrics )
+    finally:
+        server.shutdown()
+        server.server_close()
+    return
+
+
+def update_exporter_metrics( results ):
+    """ Renders and stores the metrics-text served to scrapers.
+        Called by run_daemon() after each check, in exporter mode. """
+    metrics_text = render_metrics( results, time.time() ) + render_stage_histograms()
+    exporter_state['metrics_text'] = metrics_text.encode( 'utf-8' )
+    return
+
+
+def get_metrics_request_handler():
+    """ Returns the request-handler class for the metrics server.
+        - Defined here, rather than at module-level, so `http.server` is only imported in exporter mode.
+        Called by run_exporter() """
+    import http.server
+
+    class MetricsRequestHandler( http.server.BaseHTTPRequestHandler ):
+        """ Serves the pre-rendered metrics-text at `/metrics`. """
+
+        def do_GET( self ):
+            if self.path.split( '?' )[0] not in ( '/metrics', '/' ):
+                self.send_error( 404 )
+                return
+            body = exporter_state['metrics_text']
+            self.send_response( 200 )
+            self.send_header( 'Content-Type', 'text/plain; version=0.0.4; charset=utf-8' )
+            self.send_header( 'Content-Length', str(len(body)) )
+            self.end_headers()
+            self.wfile.write( body )
+
+        def log_message( self, format, *args ):
+            log.debug( f'metrics request, ``{format % args}``' )
+
+    return MetricsRequestHandler
+
+
+def render_metrics( results, now_ts ):
+    """
+    Renders check-results as prometheus text-format metrics.
+    Called by update_exporter_metrics()
+
+    >>> result = {
+    ...     'host': 'server_a', 'previous_failed_count': 330, 'sample_ts': 1000,
+    ...     'evaluation_dct': {'queue_check': 'ok', 'worker_check': 'FAIL', 'failure_queue_check': 'ok'},
+    ...     'data_dct': {
+    ...         'failed_count': 333, 'queues': ['q1', 'failed'], 'workers_by_queue': {'q1': ['w.1'], 'failed': []},
+    ...         'queue_lengths': {'q1': 7, 'failed': 333}, 'worker_states': {'w.1': 'busy'},
+    ...         'queue_wait_times': {'q1': {'sampled': 7, 'p50_seconds': 12.0, 'p95_seconds': 30.5, 'max_seconds': 30.5}}},
+    ...     'queue_rates': {'q1': {'length': 7, 'growth_per_minute': -3.5, 'minutes_to_empty': 2.0}},
+    ...     'queue_job_counts': {'q1': {'succeeded': 95, 'failed': 5, 'processed': 100, 'failure_ratio': 0.05}} }
+    >>> print( render_metrics([result], 1005.5) )  # doctest: +ELLIPSIS
+    # HELP rq_queue_length Jobs waiting in the queue.
+    # TYPE rq_queue_length gauge
+    rq_queue_length{host="server_a",queue="q1"} 7
+    rq_queue_length{host="server_a",queue="failed"} 333
+    # HELP rq_queue_workers Workers listening on the queue.
+    # TYPE rq_queue_workers gauge
+    rq_queue_workers{host="server_a",queue="q1"} 1
+    rq_queue_workers{host="server_a",queue="failed"} 0
+    # HELP rq_queue_busy_workers Busy workers listening on the queue.
+    # TYPE rq_queue_busy_workers gauge
+    rq_queue_busy_workers{host="server_a",queue="q1"} 1
+    rq_queue_busy_workers{host="server_a",queue="failed"} 0
+    # HELP rq_queue_wait_seconds How long queued jobs have waited, from a sample; quantile 1 is the oldest job.
+    # TYPE rq_queue_wait_seconds gauge
+    rq_queue_wait_seconds{host="server_a",queue="q1",quantile="0.5"} 12.0
+    rq_queue_wait_seconds{host="server_a",queue="q1",quantile="0.95"} 30.5
+    rq_queue_wait_seconds{host="server_a",queue="q1",quantile="1"} 30.5
+    # HELP rq_queue_growth_per_minute Net change in queue length per minute, since the previous check.
+    # TYPE rq_queue_growth_per_minute gauge
+    rq_queue_growth_per_minute{host="server_a",queue="q1"} -3.5
+    # HELP rq_queue_minutes_to_empty Estimated minutes until the queue is empty, where it is draining.
+    # TYPE rq_queue_minutes_to_empty gauge
+    rq_queue_minutes_to_empty{host="server_a",queue="q1"} 2.0
+    # HELP rq_queue_failure_ratio Share of the jobs processed by the queue's workers, since the previous check, that failed.
+    # TYPE rq_queue_failure_ratio gauge
+    rq_queue_failure_ratio{host="server_a",queue="q1"} 0.05
+    # HELP rq_failed_jobs Jobs in the failed queue.
+    # TYPE rq_failed_jobs gauge
+    rq_failed_jobs{host="server_a"} 333
+    # HELP rq_failed_jobs_delta Change in failed jobs since the previous check.
+    # TYPE rq_failed_jobs_delta gauge
+    rq_failed_jobs_delta{host="server_a"} 3
+    # HELP qchkr_check_ok 1 if the check passed, else 0.
+    # TYPE qchkr_check_ok gauge
+    qchkr_check_ok{host="server_a",check="queue_check"} 1
+    qchkr_check_ok{host="server_a",check="worker_check"} 0
+    qchkr_check_ok{host="server_a",check="failure_queue_check"} 1
+    # HELP qchkr_last_check_timestamp_seconds When the host was last checked.
+    # TYPE qchkr_last_check_timestamp_seconds gauge
+    qchkr_last_check_timestamp_seconds{host="server_a"} 1000
+    # HELP qchkr_render_timestamp_seconds When these metrics were rendered.
+    # TYPE qchkr_render_timestamp_seconds gauge
+    qchkr_render_timestamp_seconds 1005.5
+    <BLANKLINE>
+    """
+    metrics = {  # name -> ( help, [ (labels, value), ... ] )
+        'rq_queue_length': ( 'Jobs waiting in the queue.', [] ),
+        'rq_queue_workers': ( 'Workers listening on the queue.', [] ),
+        'rq_queue_busy_workers': ( 'Busy workers listening on the queue.', [] ),
+        'rq_queue_wait_seconds': ( 'How long queued jobs have waited, from a sample; quantile 1 is the oldest job.', [] ),
+        'rq_queue_growth_per_minute': ( 'Net change in queue length per minute, since the previous check.', [] ),
+        'rq_queue_minutes_to_empty': ( 'Estimated minutes until the queue is empty, where it is draining.', [] ),
+        'rq_queue_failure_ratio': ( 'Share of the jobs processed by the queue\'s workers, since the previous check, that failed.', [] ),
+        'rq_failed_jobs': ( 'Jobs in the failed queue.', [] ),
+        'rq_failed_jobs_delta': ( 'Change in failed jobs since the previous check.', [] ),
+        'qchkr_check_ok': ( '1 if the check passed, else 0.', [] ),
+        'qchkr_last_check_timestamp_seconds': ( 'When the host was last checked.', [] ),
+        'qchkr_render_timestamp_seconds': ( 'When these metrics were rendered.', [ ({}, now_ts) ] ),
+        }
+    for result in results:
+        host_labels = { 'host': result['host'] }
+        data_dct = result['data_dct']
+        for ( check_name, status ) in result['evaluation_dct'].items():
+            metrics['qchkr_check_ok'][1].append( ({**host_labels, 'check': check_name}, int(status == 'ok')) )
+        if not data_dct:  # collection failed; only the check-results are known
+            continue
+        queue_utilization = compute_queue_utilization( data_dct )
+        for queue_name in data_dct['queues']:
+            queue_labels = { **host_labels, 'queue': queue_name }
+            if queue_name in data_dct.get( 'queue_lengths', {} ):
+                metrics['rq_queue_length'][1].append( (queue_labels, data_dct['queue_lengths'][queue_name]) )
+            metrics['rq_queue_workers'][1].append( (queue_labels, queue_utilization[queue_name]['total']) )
+            if queue_utilization[queue_name]['busy'] is not None:
+                metrics['rq_queue_busy_workers'][1].append( (queue_labels, queue_utilization[queue_name]['busy']) )
+            wait_times = data_dct.get( 'queue_wait_times', {} ).get( queue_name )
+            if wait_times:
+                for ( quantile, key ) in ( ('0.5', 'p50_seconds'), ('0.95', 'p95_seconds'), ('1', 'max_seconds') ):
+                    metrics['rq_queue_wait_seconds'][1].append( ({**queue_labels, 'quantile': quantile}, wait_times[key]) )
+            queue_rates = result.get( 'queue_rates', {} ).get( queue_name )
+            if queue_rates:
+                metrics['rq_queue_growth_per_minute'][1].append( (queue_labels, queue_rates['growth_per_minute']) )
+                if queue_rates['minutes_to_empty'] is not None:
+                    metrics['rq_queue_minutes_to_empty'][1].append( (queue_labels, queue_rates['minutes_to_empty']) )
+            job_counts = result.get( 'queue_job_counts', {} ).get( queue_name )
+            if job_counts and job_counts['failure_ratio'] is not None:
+                metrics['rq_queue_failure_ratio'][1].append( (queue_labels, job_counts['failure_ratio']) )
+        metrics['rq_failed_jobs'][1].append( (host_labels, data_dct['failed_count']) )
+        if result['previous_failed_count'] is not None:
+            metrics['rq_failed_jobs_delta'][1].append( (host_labels, data_dct['failed_count'] - result['previous_failed_count']) )
+        metrics['qchkr_last_check_timestamp_seconds'][1].append( (host_labels, result['sample_ts']) )
+    lines = []
+    for ( metric_name, (help_text, samples) ) in metrics.items():
+        lines.append( f'# HELP {metric_name} {help_text}' )
+        lines.append( f'# TYPE {metric_name} gauge' )
+        for ( labels, value ) in samples:
+            lines.append( f'{metric_name}{format_metric_labels(labels)} {value}' )
+    return '\n'.join( lines ) + '\n'
+
+
+def format_metric_labels( labels ):
+    """ Returns prometheus label-syntax for a dict, escaping backslashes, quotes and newlines.
+        Called by render_metrics()
+    >>> format_metric_labels( {'queue': 'odd "name"'} )
+    '{queue="odd \\\\"name\\\\""}'
+    >>> format_metric_labels( {} )
+    ''
+    """
+    if not labels:
+        return ''
+    escaped = [ (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for (key, value) in labels.items() ]
+    return '{' + ','.join( f'{key}="{value}"' for (key, value) in escaped ) + '}'
+
+
+## fleet mode -----------------------------------------------------
+
+
+def collect_fleet_results( expectations_dct, state_dir_path ):
+    """
+    Checks each host on a bounded thread-pool, so total wall-time stays close to that of the slowest host.
+    Each host-entry has a `name`, a `redis_url`, and optionally an `expectations` dict overriding the top-level expectations.
+    The pool-size comes from `fleet_max_workers` (default 16).
+    Called by run_checks()
+
+    Example (redis connections pre-seeded with in-process stand-ins):
+    >>> import tempfile
+    >>> redis_connections['local://a'] = LocalRedis(
+    ...     sets={'rq:queues': {'rq:queue:q1', 'rq:queue:failed'}, 'rq:workers': {'rq:worker:a.1'}},
+    ...     hashes={'rq:worker:a.1': {'queues': 'q1'}} )
+    >>> redis_connections['local://b'] = LocalRedis( sets={'rq:queues': {'rq:queue:failed'}} )
+    >>> fleet_expectations = {
+    ...     'expected_queues': ['q1'], 'expected_workers': [{'queue': 'q1', 'worker_count': 1}], 'surge_failure_limit': 10,
+    ...     'hosts': [ {'name': 'a', 'redis_url': 'local://a'}, {'name': 'b', 'redis_url': 'local://b'} ] }
+    >>> with tempfile.TemporaryDirectory() as state_dir:
+    ...     results = collect_fleet_results( fleet_expectations, state_dir )
+    >>> [ (result['host'], result['evaluation_dct']['queue_check']) for result in results ]
+    [('a', 'ok'), ('b', 'FAIL')]
+    """
+    hosts = expectations_dct['hosts']
+    shared_expectations = { key: value for (key, value) in expectations_dct.items() if key != 'hosts' }
+    max_workers = max( 1, min(expectations_dct.get('fleet_max_workers', 16), len(hosts)) )
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor( max_workers=max_workers ) as executor:
+        results = list( executor.map(lambda host_dct: check_fleet_host(host_dct, shared_expectations, state_dir_path), hosts) )
+    return results
+
+
+def check_fleet_host( host_dct, shared_expectations, state_dir_path ):
+    """ Collects and checks one fleet host; a collection problem is reported as a failed check rather than raised.
+        Called by collect_fleet_results() """
+    host_name = host_dct['name']
+    host_expectations = { **shared_expectations, **host_dct.get('expectations', {}) }
+    state_file_path = f'{state_dir_path}/previous_rqinfo_data__{make_safe_filename(host_name)}.json'
+    try:
+        with timed_stage( 'collect' ):
+            redis_conn = get_redis_connection( host_dct['redis_url'] )
+            data_dct = collect_redis_data( redis_conn )
+        check_result = check_rqinfo_data( host_name, data_dct, host_expectations, state_file_path, redis_conn )
+        check_result['error'] = None
+    except Exception as e:
+        log.exception( f'problem checking host, ``{host_name}``; traceback follows' )
+        violations = [ {'check': 'collect_check', 'queue': None, 'expected': 'ok', 'actual': 'error', 'detail': f'problem checking host; err, ``{repr(e)}``'} ]
+        check_result = {
+            'data_dct': {},
+            'evaluation_dct': {'queue_check': 'FAIL', 'worker_check': 'FAIL', 'failure_queue_check': 'FAIL'},
+            'violations': violations,
+            'notifications': track_alerts( host_name, violations, host_expectations, state_file_path, int(time.time()), keep_unchecked=True ),
+            'queue_rates': {},
+            'failure_groups': None,
+            'previous_failed_count': None,
+            'error': repr( e ) }
+    check_result['host'] = host_name
+    check_result['expectations'] = host_expectations
+    return check_result
+
+
+def make_safe_filename( name ):
+    """ Returns name with anything other than letters, digits, dot, dash and underscore replaced by an underscore.
+        Called by check_fleet_host()
+    >>> make_safe_filename( 'redis-1.example.edu:6379/0' )
+    'redis-1.example.edu_6379_0'
+    """
+    return re.sub( r'[^A-Za-z0-9._-]', '_', name )
+
+
+def build_fleet_email_message( results ):
+    """ Assembles one combined email message for a fleet check: a per-host summary, then details for each host with alert changes.
+        Called by send_alerts() """
+    assert type(results) == list
+    summary_lines = []
+    detail_sections = []
+    for result in results:
+        evaluation_dct = result['evaluation_dct']
+        status = 'ok' if all( value == 'ok' for value in evaluation_dct.values() ) else 'FAIL'
+        summary_lines.append( f'{result["host"]}: {status} -- {repr(evaluation_dct)}' )
+        if result['notifications']:
+            error_line = f'COLLECTION-ERROR: {result["error"]}' if result['error'] else ''
+            host_message = build_email_message(
+                result['previous_failed_count'], result['expectations'], evaluation_dct, result['data_dct'], result['violations'], result['notifications'], result['queue_rates'],
+                result.get('failure_groups') )
+            detail_sections.append( f'''
+HOST: {result["host"]} ======================================================
+{error_line}
+{host_message}''' )
+    summary = '\n'.join( summary_lines )
+    details = '\n'.join( detail_sections )
+    msg = f'''
+FLEET SUMMARY -------------------------------------------------------
+{summary}
+{details}
+'''
+    log.debug( f'msg, ``{msg}``' )
+    return msg
 
 
 ## helper functions called by run_code() ----------------------------
 
 
-def load_previous_rqinfo_data( current_rqinfo_data ):
+def load_previous_rqinfo_data( current_rqinfo_data, file_path=STATE_FILE_PATH ):
     """
     Loads previous rqinfo data from file.
-    Called by run_code().
-    On failure, saves current data to file, and returns current-data.
-        - This enables a smooth first run of the script. """
+    Called by check_rqinfo_data().
+    If there's no file, saves current data to file, and returns current-data.
+        - This enables a smooth first run of the script.
+    If the file is corrupt (bad checksum, truncated), moves it aside and raises,
+        - so the problem is reported rather than hidden by silently starting over. """
     try:
-        with open( '../previous_rqinfo_data/previous_rqinfo_data.json', 'r' ) as f:
-            previous_rqinfo_data = json.loads( f.read() )
-        assert type(previous_rqinfo_data) == dict
-        log.debug( f' previous_rqinfo_data, loaded from file, ``{pprint.pformat(previous_rqinfo_data)}``' )
+        with open( file_path, 'rb' ) as f:
+            previous_rqinfo_data = decode_state( f.read() )
+        if log.isEnabledFor( logging.DEBUG ):  # pretty-printing a large state costs more than loading it
+            import pprint
+            log.debug( f' previous_rqinfo_data, loaded from file, ``{pprint.pformat(previous_rqinfo_data)}``' )
+    except StateFileCorruptError as e:
+        corrupt_file_path = f'{file_path}.corrupt-{int(time.time())}'
+        os.replace( file_path, corrupt_file_path )
+        log.error( f'previous data corrupt; err, ``{e}``; moved to ``{corrupt_file_path}``' )
+        raise
     except Exception as e:
         log.warning( f'exception loading previous data; err, ``{e}``; will save existing data.' )
-        save_rqinfo_data( current_rqinfo_data )
+        save_rqinfo_data( current_rqinfo_data, file_path )
         previous_rqinfo_data = current_rqinfo_data
-        log.debug( f' previous_rqinfo_data, from _current_ data, ``{pprint.pformat(previous_rqinfo_data)}``' )
+        log.debug( ' previous_rqinfo_data, from _current_ data' )
     return previous_rqinfo_data
 
 
@@ -101,22 +754,41 @@ def load_previous_rqinfo_data( current_rqinfo_data ):
 #     return previous_rqinfo_data
 
 
-def get_rqinfo() -> str:
-    """ Runs `rqinfo`, returns output.
+def get_rqinfo_data() -> dict:
+    """ Returns rqinfo data-dict.
+        - If the `QCHKR__REDIS_URL` envar is set, reads the rq keys directly from redis, via `collect_redis_data()`.
+        - Otherwise, or if the direct read fails, falls back to running and parsing `rqinfo`.
+        Called by run_checks() """
+    redis_url = os.environ.get( 'QCHKR__REDIS_URL', '' )
+    if redis_url:
+        try:
+            redis_conn = get_redis_connection( redis_url )
+            data_dct = collect_redis_data( redis_conn )
+            return data_dct
+        except Exception as e:
+            log.warning( f'problem reading rq data from redis; err, ``{repr(e)}``; falling back to rqinfo' )
+    data_dct = read_rqinfo()
+    return data_dct
+
+
+def read_rqinfo() -> dict:
+    """ Runs `rqinfo`, parsing its output line-by-line as it arrives on the pipe, so the full output is never held in memory.
         - `--by-queue` returns the normal queue output, but shows workers associated with each queue.
         - `--raw` doesn't return the summary line or the job-bar, just the basic data. 
-        Called by run_code() """
-    result = subprocess.run(['rqinfo', '--by-queue', '--raw'], stdout=subprocess.PIPE)
-    output = result.stdout.decode()
-    assert type(output) == str
-    log.debug( f'output, ``{output}``' )
-    return output
+        Called by get_rqinfo_data() """
+    import subprocess
+    process = subprocess.Popen( ['rqinfo', '--by-queue', '--raw'], stdout=subprocess.PIPE )
+    with process.stdout:
+        lines = io.TextIOWrapper( process.stdout, encoding='utf-8' )
+        data_dct = parse_rqinfo_lines( lines )
+    process.wait()
+    log.debug( f'rqinfo exit-code, ``{process.returncode}``' )
+    return data_dct
 
 
 def parse_rqinfo( rq_output ):
     """ 
-    Parses rqinfo output into a dict.
-    Called by run_code().
+    Parses already-captured rqinfo output into a dict; a string-wrapper around parse_rqinfo_lines().
     Doctest usage (w/env sourced): `% python -m doctest ./queue_check.py`
 
     Example:
@@ -129,26 +801,46 @@ def parse_rqinfo( rq_output ):
     ...     'failed: –\\n'
     ... )
     >>> result
-    {'failed_count': 333, 'queues': ['q_1', 'q_2', 'failed'], 'workers_by_queue': {'q_1': ['server.968', 'server.952'], 'q_2': ['server.952'], 'failed': []}}
+    {'failed_count': 333, 'queues': ['q_1', 'q_2', 'failed'], 'workers_by_queue': {'q_1': ['server.968', 'server.952'], 'q_2': ['server.952'], 'failed': []}, 'queue_lengths': {'q_1': 0, 'q_2': 0, 'failed': 333}, 'worker_states': {'server.968': 'idle', 'server.952': 'idle'}}
+    >>> import pprint
     >>> pprint.pprint( result )
     {'failed_count': 333,
+     'queue_lengths': {'failed': 333, 'q_1': 0, 'q_2': 0},
      'queues': ['q_1', 'q_2', 'failed'],
+     'worker_states': {'server.952': 'idle', 'server.968': 'idle'},
      'workers_by_queue': {'failed': [],
                           'q_1': ['server.968', 'server.952'],
                           'q_2': ['server.952']}}
     """
-    lines = rq_output.split('\n')
-    log.debug( f'lines, ``{lines}``' )
-    output = {'failed_count': 0, 'queues': [], 'workers_by_queue': {}}
+    assert type(rq_output) == str
+    output = parse_rqinfo_lines( io.StringIO(rq_output) )
+    return output
+
+
+def parse_rqinfo_lines( lines ):
+    """ 
+    Parses rqinfo output, from any iterable of lines (a list, a file, a pipe), into a dict.
+    Lines are consumed one at a time, so peak memory is bounded by the longest line plus the resulting dict.
+    Called by read_rqinfo() and parse_rqinfo().
+
+    >>> def trickle():  # a generator, like a pipe
+    ...     yield 'queue q_1 2\\n'
+    ...     yield 'queue failed 5\\n'
+    ...     yield '\\n'
+    ...     yield 'q_1: server.968 (busy)\\n'
+    ...     yield 'failed: –\\n'
+    >>> parse_rqinfo_lines( trickle() )
+    {'failed_count': 5, 'queues': ['q_1', 'failed'], 'workers_by_queue': {'q_1': ['server.968'], 'failed': []}, 'queue_lengths': {'q_1': 2, 'failed': 5}, 'worker_states': {'server.968': 'busy'}}
+    """
+    output = {'failed_count': 0, 'queues': [], 'workers_by_queue': {}, 'queue_lengths': {}, 'worker_states': {}}
     for line in lines:
-        log.debug( f'processing line, ``{line}``' )
         line = line.strip()
         if line == '':
-            log.debug( 'blank line; continuing' )
             continue
-        if line.startswith('queue'):    # Line format: queue <queue_name> <count>
+        if line.startswith('queue '):   # Line format: queue <queue_name> <count>
             ( _, queue_name, count ) = line.split()
             output['queues'].append(queue_name)
+            output['queue_lengths'][queue_name] = int(count)
             if queue_name == 'failed':
                 output['failed_count'] = int(count)
         else:                           # Line format: <queue_name>: <worker.123 (idle), worker.124 (idle)> ...or...
@@ -156,29 +848,484 @@ def parse_rqinfo( rq_output ):
             ( queue_name, worker_data ) = line.split(':')
             worker_data = worker_data.strip()
             worker_names = []
-            if worker_data != '–':      # Split by comma and get the worker name from each part
-                worker_names = [part.split()[0] for part in worker_data.split(',')]
+            if worker_data != '–':      # Split by comma and get the worker name, and state, from each part
+                for part in worker_data.split(','):
+                    ( worker_name, *state ) = part.split()
+                    worker_names.append( worker_name )
+                    output['worker_states'][worker_name] = state[0].strip( '()' ) if state else None
             output['workers_by_queue'][queue_name] = worker_names
-    log.debug( f'output, ``{pprint.pformat(output)}``' )
+    log.debug( f'parsed ``{len(output["queues"])}`` queues and ``{len(output["workers_by_queue"])}`` worker-lists' )
     return output
-    # end def parse_rqinfo()
+    # end def parse_rqinfo_lines()
 
 
-def save_rqinfo_data( data_dct ):
-    """ Saves rqinfo data to file.
-        Called by run_code() """
+## direct redis collector -------------------------------------------
+
+RQ_QUEUES_KEY = 'rq:queues'
+RQ_WORKERS_KEY = 'rq:workers'
+RQ_QUEUE_KEY_PREFIX = 'rq:queue:'
+RQ_WORKER_KEY_PREFIX = 'rq:worker:'
+RQ_JOB_KEY_PREFIX = 'rq:job:'
+RQ_WORKER_FIELDS = ( 'queues', 'state', 'last_heartbeat', 'current_job', 'successful_job_count', 'failed_job_count' )
+
+redis_connections: dict = {}  # keyed by redis-url; lets long-running processes reuse connections
+
+
+def get_redis_connection( redis_url ):
+    """ Returns a (cached) redis connection for the given url.
+        - `redis` is imported here so the `rqinfo` path works without it.
+        - Responses aren't decoded by the connection, since rq stores job `exc_info` zlib-compressed;
+            the collectors decode values with decode_redis_value(), and exc_info with decode_exc_info().
+        Called by get_rqinfo_data() """
+    if redis_url not in redis_connections:
+        import redis
+        redis_connections[redis_url] = redis.Redis.from_url( redis_url )
+        log.debug( f'new redis connection for, ``{redis_url}``' )
+    return redis_connections[redis_url]
+
+
+def decode_redis_value( value ):
+    """ Returns str for bytes values (connections not using `decode_responses`); otherwise the value unchanged.
+        Called by the redis collector functions.
+    >>> decode_redis_value( b'rq:queue:q_1' )
+    'rq:queue:q_1'
+    >>> decode_redis_value( None ) is None
+    True
+    """
+    if type(value) == bytes:
+        value = value.decode( 'utf-8' )
+    return value
+
+
+def decode_exc_info( value ):
+    """ Returns a job's `exc_info` as str: zlib-decompressed, as rq stores it, falling back to plain text, as rq's `Job.restore()` does.
+        Called by analyze_failed_jobs()
+    >>> decode_exc_info( zlib.compress(b'ValueError: bad') )
+    'ValueError: bad'
+    >>> decode_exc_info( b'ValueError: bad' ), decode_exc_info( 'ValueError: bad' ), decode_exc_info( None )
+    ('ValueError: bad', 'ValueError: bad', None)
+    """
+    if type(value) != bytes:
+        return value
+    try:
+        value = zlib.decompress( value )
+    except zlib.error:
+        pass  # stored uncompressed
+    return value.decode( 'utf-8', errors='replace' )
+
+
+def collect_redis_data( redis_conn, now_ts=None ):
+    """
+    Reads rq's queue and worker keys directly from redis; returns the same dict-shape as parse_rqinfo(),
+      plus a `workers` dict of each worker's queues, state, heartbeat-age, current job, seconds on that job,
+      and successful and failed job-counts,
+      and sampled `queue_wait_times`.
+    Uses two pipelined round-trips: one for the queue and worker sets, one for all queue-lengths and worker-hashes;
+      and, only if some workers have a current job, a third for those jobs' start-times.
+    Then, if any queue has jobs, two more to sample queued jobs' wait-times (see collect_queue_wait_times()).
+    Called by get_rqinfo_data()
+
+    Example:
+    >>> conn = LocalRedis(
+    ...     sets={
+    ...         'rq:queues': {'rq:queue:q_1', 'rq:queue:q_2', 'rq:queue:failed'},
+    ...         'rq:workers': {'rq:worker:server.968', 'rq:worker:server.952', 'rq:worker:expired.1'} },
+    ...     lists={ 'rq:queue:failed': [f'job_{i}' for i in range(333)] },
+    ...     hashes={
+    ...         'rq:worker:server.968': {'queues': 'q_1', 'state': 'idle'},
+    ...         'rq:worker:server.952': {'queues': 'q_1,q_2', 'state': 'idle'} } )
+    >>> import pprint
+    >>> pprint.pprint( collect_redis_data(conn) )
+    {'failed_count': 333,
+     'queue_lengths': {'failed': 333, 'q_1': 0, 'q_2': 0},
+     'queue_wait_times': {},
+     'queues': ['failed', 'q_1', 'q_2'],
+     'worker_states': {'server.952': 'idle', 'server.968': 'idle'},
+     'workers': {'server.952': {'current_job': None,
+                                'failed_job_count': None,
+                                'heartbeat_age_seconds': None,
+                                'job_seconds': None,
+                                'queues': ['q_1', 'q_2'],
+                                'state': 'idle',
+                                'successful_job_count': None},
+                 'server.968': {'current_job': None,
+                                'failed_job_count': None,
+                                'heartbeat_age_seconds': None,
+                                'job_seconds': None,
+                                'queues': ['q_1'],
+                                'state': 'idle',
+                                'successful_job_count': None}},
+     'workers_by_queue': {'failed': [],
+                          'q_1': ['server.952', 'server.968'],
+                          'q_2': ['server.952']}}
+    >>> conn.execute_count
+    2
+
+    A busy worker:
+    >>> conn = LocalRedis(
+    ...     sets={ 'rq:queues': {'rq:queue:q_1'}, 'rq:workers': {'rq:worker:server.968'} },
+    ...     hashes={
+    ...         'rq:worker:server.968': {'queues': 'q_1', 'state': 'busy', 'last_heartbeat': '2020-01-01T00:09:30.000000Z', 'current_job': 'abc'},
+    ...         'rq:job:abc': {'started_at': '2020-01-01T00:00:00Z'} } )
+    >>> collect_redis_data( conn, now_ts=parse_rq_timestamp('2020-01-01T00:10:00Z') )['workers']['server.968']
+    {'queues': ['q_1'], 'state': 'busy', 'heartbeat_age_seconds': 30.0, 'current_job': 'abc', 'job_seconds': 600.0, 'successful_job_count': None, 'failed_job_count': None}
+    >>> conn.execute_count
+    3
+    """
+    now_ts = time.time() if now_ts is None else now_ts
+    ## get queue and worker keys ------------------------------------
+    pipe = redis_conn.pipeline( transaction=False )
+    pipe.smembers( RQ_QUEUES_KEY )
+    pipe.smembers( RQ_WORKERS_KEY )
+    ( queue_keys, worker_keys ) = pipe.execute()
+    queue_keys = sorted( decode_redis_value(key) for key in queue_keys )
+    worker_keys = sorted( decode_redis_value(key) for key in worker_keys )
+    if log.isEnabledFor( logging.DEBUG ):  # skips formatting per-queue data at INFO
+        log.debug( f'queue_keys, ``{queue_keys}``; worker_keys, ``{worker_keys}``' )
+    ## get queue lengths and worker-hashes --------------------------
+    pipe = redis_conn.pipeline( transaction=False )
+    for queue_key in queue_keys:
+        pipe.llen( queue_key )
+    for worker_key in worker_keys:
+        pipe.hmget( worker_key, RQ_WORKER_FIELDS )
+    results = pipe.execute()
+    queue_lengths = results[:len(queue_keys)]
+    worker_hashes = results[len(queue_keys):]
+    ## build output -------------------------------------------------
+    output = {'failed_count': 0, 'queues': [], 'workers_by_queue': {}, 'queue_lengths': {}, 'worker_states': {}, 'workers': {}}
+    for ( queue_key, length ) in zip( queue_keys, queue_lengths ):
+        queue_name = queue_key[len(RQ_QUEUE_KEY_PREFIX):]
+        output['queues'].append( queue_name )
+        output['queue_lengths'][queue_name] = int( length )
+        output['workers_by_queue'][queue_name] = []
+        if queue_name == 'failed':
+            output['failed_count'] = int( length )
+    for ( worker_key, worker_hash ) in zip( worker_keys, worker_hashes ):
+        ( worker_queues, state, last_heartbeat, current_job, successful_job_count, failed_job_count ) = [
+            decode_redis_value(value) for value in worker_hash ]
+        if worker_queues is None:   # worker-key expired since the `rq:workers` read; rqinfo skips these too
+            log.debug( f'no worker hash for, ``{worker_key}``; skipping' )
+            continue
+        worker_name = worker_key[len(RQ_WORKER_KEY_PREFIX):]
+        for queue_name in worker_queues.split( ',' ):
+            output['workers_by_queue'].setdefault( queue_name, [] ).append( worker_name )
+        output['worker_states'][worker_name] = state
+        heartbeat_ts = parse_rq_timestamp( last_heartbeat )
+        output['workers'][worker_name] = {
+            'queues': worker_queues.split( ',' ),
+            'state': state,
+            'heartbeat_age_seconds': None if heartbeat_ts is None else round( now_ts - heartbeat_ts, 1 ),
+            'current_job': current_job or None,
+            'job_seconds': None,
+            'successful_job_count': None if successful_job_count is None else int( successful_job_count ),
+            'failed_job_count': None if failed_job_count is None else int( failed_job_count ) }
+    ## get current jobs' start-times --------------------------------
+    busy_workers = [ (name, worker) for (name, worker) in output['workers'].items() if worker['current_job'] ]
+    if busy_workers:
+        pipe = redis_conn.pipeline( transaction=False )
+        for ( _, worker ) in busy_workers:
+            pipe.hget( f'{RQ_JOB_KEY_PREFIX}{worker["current_job"]}', 'started_at' )
+        for ( ( _, worker ), started_at ) in zip( busy_workers, pipe.execute() ):
+            started_ts = parse_rq_timestamp( decode_redis_value(started_at) )
+            if started_ts is not None:
+                worker['job_seconds'] = round( now_ts - started_ts, 1 )
+    ## sample queued jobs' wait-times -------------------------------
+    output['queue_wait_times'] = collect_queue_wait_times( redis_conn, output['queue_lengths'], now_ts )
+    if log.isEnabledFor( logging.DEBUG ):
+        import pprint
+        log.debug( f'output, ``{pprint.pformat(output)}``' )
+    return output
+    # end def collect_redis_data()
+
+
+WAIT_SAMPLE_SIZE = 10  # random jobs sampled per queue, besides the oldest
+
+
+def collect_queue_wait_times( redis_conn, queue_lengths, now_ts, rng=None ):
+    """
+    Returns, for each non-empty queue (other than `failed`), how long its jobs have been waiting:
+      the oldest job's wait (the job at the queue's head -- rq appends to the tail), and the median and 95th percentile
+      of the oldest job plus up to WAIT_SAMPLE_SIZE randomly-chosen others.
+    Uses two pipelined round-trips, whatever the number of queues: LINDEXes for the sampled job-ids, then HGETs of their `enqueued_at`.
+    Called by collect_redis_data()
+
+    >>> conn = LocalRedis(
+    ...     lists={ 'rq:queue:q_1': ['a', 'b', 'c'] },
+    ...     hashes={ f'rq:job:{job_id}': {'enqueued_at': f'1970-01-01T00:0{minute}:00Z'} for (job_id, minute) in (('a', 1), ('b', 5), ('c', 8)) } )
+    >>> collect_queue_wait_times( conn, {'q_1': 3, 'q_2': 0, 'failed': 9}, now_ts=600, rng=random.Random(0) )
+    {'q_1': {'sampled': 3, 'p50_seconds': 300.0, 'p95_seconds': 540.0, 'max_seconds': 540.0}}
+    >>> conn.execute_count
+    2
+    """
+    rng = rng or random.Random()
+    sample_indexes = {}
+    for ( queue_name, length ) in queue_lengths.items():
+        if queue_name == 'failed' or not length:
+            continue
+        sample_indexes[queue_name] = [ 0 ] + sorted( rng.sample(range(1, length), min(WAIT_SAMPLE_SIZE, length - 1)) )
+    if not sample_indexes:
+        return {}
+    ## get sampled job-ids ------------------------------------------
+    pipe = redis_conn.pipeline( transaction=False )
+    for ( queue_name, indexes ) in sample_indexes.items():
+        for index in indexes:
+            pipe.lindex( f'{RQ_QUEUE_KEY_PREFIX}{queue_name}', index )
+    job_ids = iter( pipe.execute() )
+    sampled_job_ids = {  # jobs taken off the queue since the length was read come back as None
+        queue_name: [ decode_redis_value(job_id) for job_id in (next(job_ids) for _ in indexes) ]
+        for ( queue_name, indexes ) in sample_indexes.items() }
+    ## get their enqueue-times --------------------------------------
+    pipe = redis_conn.pipeline( transaction=False )
+    for ( queue_name, queue_job_ids ) in sampled_job_ids.items():
+        for job_id in queue_job_ids:
+            pipe.hget( f'{RQ_JOB_KEY_PREFIX}{job_id}', 'enqueued_at' )
+    enqueued_ats = iter( pipe.execute() )
+    queue_wait_times = {}
+    for ( queue_name, queue_job_ids ) in sampled_job_ids.items():
+        enqueued_timestamps = [ parse_rq_timestamp( decode_redis_value(next(enqueued_ats)) ) for _ in queue_job_ids ]
+        waits = sorted( now_ts - enqueued_ts for enqueued_ts in enqueued_timestamps if enqueued_ts is not None )
+        if not waits:
+            continue
+        queue_wait_times[queue_name] = {
+            'sampled': len( waits ),
+            'p50_seconds': round( get_percentile(waits, 0.5), 1 ),
+            'p95_seconds': round( get_percentile(waits, 0.95), 1 ),
+            'max_seconds': round( waits[-1], 1 ) }
+    return queue_wait_times
+
+
+def get_percentile( sorted_values, fraction ):
+    """ Returns the nearest-rank percentile of already-sorted values.
+        Called by collect_queue_wait_times()
+    >>> get_percentile( [1, 2, 3, 4], 0.5 ), get_percentile( [1, 2, 3, 4], 0.95 )
+    (2, 4)
+    """
+    rank = max( 1, -(-len(sorted_values) * fraction // 1) )  # ceiling
+    return sorted_values[int(rank) - 1]
+
+
+def parse_rq_timestamp( value ):
+    """ Returns epoch-seconds for rq's utc timestamp-strings (with or without microseconds), or None.
+        Called by collect_redis_data()
+    >>> parse_rq_timestamp( '1970-01-01T00:01:00.500000Z' ), parse_rq_timestamp( '1970-01-01T00:01:00Z' ), parse_rq_timestamp( None )
+    (60.5, 60.0, None)
+    """
+    if not value:
+        return None
+    for timestamp_format in ( '%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ' ):
+        try:
+            return datetime.datetime.strptime( value, timestamp_format ).replace( tzinfo=datetime.timezone.utc ).timestamp()
+        except ValueError:
+            continue
+    log.debug( f'unparseable rq timestamp, ``{value}``' )
+    return None
+
+
+## failed-job analysis ----------------------------------------------
+##
+## Groups the jobs that failed since the previous check by function, exception class, and origin queue.
+## The state-file keeps a cursor into the `failed` list, so each check reads only the new entries,
+##   a page at a time, and only counts are kept -- memory is bounded by the number of groups, not jobs.
+## rq appends failed jobs to the list's tail, but requeueing or deleting jobs removes entries from anywhere in it,
+##   shifting later entries towards the head. So besides its offset, the cursor holds "anchors" -- the job-ids
+##   1, 2, 4, 8... entries back from the offset -- and, when the entry just before the offset has changed,
+##   finds where the newest surviving anchor has moved to.
+
+FAILED_JOBS_PAGE_SIZE = 500
+FAILED_JOBS_SCAN_LIMIT = 20000  # most new failures read per check; the cursor picks up the rest next time
+FAILED_JOBS_TOP_GROUPS = 10
+RQ_JOB_FAILURE_FIELDS = ( 'description', 'exc_info', 'origin' )
+FAILED_CURSOR_ANCHOR_COUNT = 16  # anchors reach back 2 ** 15 entries
+FAILED_CURSOR_SEARCH_LIMIT = 50000  # most entries read, backwards from the offset, looking for an anchor
+FAILED_CURSOR_SEARCH_PAGE_SIZE = 5000
+
+
+def analyze_new_failed_jobs( redis_conn, previous_rqinfo_data, data_dct ):
+    """ Runs analyze_failed_jobs() from the previous check's cursor, storing the new cursor in `data_dct` (so it's saved with the state).
+        - With no previous cursor (first run, or state from an older version), starts the cursor at the current end of the list,
+            rather than reading the whole backlog.
+        - Problems are logged, not raised; the analysis is extra detail, and mustn't stop the check.
+        Called by check_rqinfo_data() """
+    failed_length = data_dct['failed_count']
+    previous_cursor = previous_rqinfo_data.get( 'failed_cursor' )
+    try:
+        if previous_cursor is None:
+            data_dct['failed_cursor'] = build_failed_cursor( redis_conn, failed_length )
+            log.debug( f'no failed-job cursor; starting at, ``{failed_length}``' )
+            return None
+        ( failure_groups, data_dct['failed_cursor'] ) = analyze_failed_jobs( redis_conn, previous_cursor, failed_length )
+    except Exception as e:
+        log.warning( f'problem analyzing failed jobs; err, ``{repr(e)}``' )
+        data_dct['failed_cursor'] = previous_cursor
+        failure_groups = None
+    return failure_groups
+
+
+def analyze_failed_jobs( redis_conn, cursor, failed_length, page_size=FAILED_JOBS_PAGE_SIZE, scan_limit=FAILED_JOBS_SCAN_LIMIT ):
+    """
+    Reads the `failed` list from the cursor's position up to `failed_length`, a page at a time:
+      one LRANGE for the page's job-ids, then one pipelined round-trip of HMGETs for those jobs' details.
+    Returns ( failure-groups, new cursor ).
+    Called by analyze_new_failed_jobs()
+
+    >>> jobs = { f'rq:job:j{i}': {'description': f'app.tasks.{"send" if i % 3 else "index"}(id={i})', 'origin': 'default',
+    ...     'exc_info': zlib.compress( b'Traceback (most recent call last):\\n  ...\\nsmtplib.SMTPException: refused\\n' )} for i in range(10) }
+    >>> conn = LocalRedis( lists={'rq:queue:failed': [f'j{i}' for i in range(10)]}, hashes=jobs )
+    >>> ( failure_groups, cursor ) = analyze_failed_jobs( conn, build_failed_cursor(conn, 4), 10, page_size=4 )
+    >>> failure_groups['scanned'], cursor
+    (6, {'offset': 10, 'anchors': [[9, 'j9'], [8, 'j8'], [6, 'j6'], [2, 'j2']]})
+    >>> for group in failure_groups['groups']:
+    ...     print( group )
+    {'function': 'app.tasks.send', 'exception': 'smtplib.SMTPException', 'origin': 'default', 'count': 4}
+    {'function': 'app.tasks.index', 'exception': 'smtplib.SMTPException', 'origin': 'default', 'count': 2}
+    >>> conn.execute_count  # pipelined round-trips: 1 each to build the old and new cursors, and 1 per page of job-details
+    4
+    """
+    offset = resolve_failed_cursor( redis_conn, cursor, failed_length )
+    end = min( failed_length, offset + scan_limit )
+    group_counts = {}
+    scanned = 0
+    while offset < end:
+        job_ids = [ decode_redis_value(job_id) for job_id in redis_conn.lrange( f'{RQ_QUEUE_KEY_PREFIX}failed', offset, min(end, offset + page_size) - 1 ) ]
+        if not job_ids:
+            break
+        pipe = redis_conn.pipeline( transaction=False )
+        for job_id in job_ids:
+            pipe.hmget( f'{RQ_JOB_KEY_PREFIX}{job_id}', RQ_JOB_FAILURE_FIELDS )
+        for job_fields in pipe.execute():
+            ( description, origin ) = ( decode_redis_value(job_fields[0]), decode_redis_value(job_fields[2]) )
+            exc_info = decode_exc_info( job_fields[1] )
+            group_key = ( parse_job_function(description), parse_exception_class(exc_info), origin or '(unknown)' )
+            group_counts[group_key] = group_counts.get( group_key, 0 ) + 1
+        scanned += len( job_ids )
+        offset += len( job_ids )
+    top_groups = sorted( group_counts.items(), key=lambda item: (-item[1], item[0]) )[:FAILED_JOBS_TOP_GROUPS]
+    failure_groups = {
+        'scanned': scanned,
+        'remaining': max( 0, failed_length - offset ),
+        'groups': [ {'function': function, 'exception': exception, 'origin': origin, 'count': count}
+            for ( (function, exception, origin), count ) in top_groups ] }
+    if log.isEnabledFor( logging.DEBUG ):
+        log.debug( f'failure_groups, ``{failure_groups}``' )
+    return ( failure_groups, build_failed_cursor(redis_conn, offset) )
+
+
+def build_failed_cursor( redis_conn, offset ):
+    """ Returns a cursor at `offset` into the `failed` list, with anchors -- [position, job-id] pairs -- at offset-1, -2, -4, -8...
+        Reads the anchors with one pipelined round-trip of LINDEXes.
+        Called by analyze_new_failed_jobs() and analyze_failed_jobs() """
+    positions = [ offset - 2 ** power for power in range(FAILED_CURSOR_ANCHOR_COUNT) if offset - 2 ** power >= 0 ]
+    pipe = redis_conn.pipeline( transaction=False )
+    for position in positions:
+        pipe.lindex( f'{RQ_QUEUE_KEY_PREFIX}failed', position )
+    job_ids = pipe.execute() if positions else []
+    anchors = [ [position, decode_redis_value(job_id)] for ( position, job_id ) in zip( positions, job_ids ) if job_id is not None ]
+    return { 'offset': offset, 'anchors': anchors }
+
+
+def resolve_failed_cursor( redis_conn, cursor, failed_length ):
+    """
+    Returns the position in the `failed` list where the entries added since the cursor was made begin.
+    - If the newest anchor is still where it was, nothing before the offset was removed, so that's the offset (one round-trip).
+    - Otherwise pages backwards from the offset, looking for the newest anchor that's still in the list; new entries start after it.
+      Up to the distance back to that anchor, entries that were already read may be read again.
+    - If no anchor turns up, (most of) the list was removed: a short list is read from its head, otherwise from the old offset.
+    - Cursors without anchors (from an older version) are taken at their offset, or from the head if the list shrank below it.
+    Called by analyze_failed_jobs()
+
+    >>> conn = LocalRedis( lists={'rq:queue:failed': [f'j{i}' for i in range(20)]} )
+    >>> cursor = build_failed_cursor( conn, 20 )
+    >>> conn.lists['rq:queue:failed'].extend( ['n1', 'n2'] )
+    >>> resolve_failed_cursor( conn, cursor, 22 )  # unchanged
+    20
+    >>> for job_id in ( 'j19', 'j18', 'j3' ):  # requeued
+    ...     conn.lists['rq:queue:failed'].remove( job_id )
+    >>> new_position = resolve_failed_cursor( conn, cursor, 19 )  # newest surviving anchor, j16, is now at 15
+    >>> new_position, conn.lists['rq:queue:failed'][new_position:]
+    (16, ['j17', 'n1', 'n2'])
+    >>> conn.lists['rq:queue:failed'] = ['n3']  # emptied, then a new failure
+    >>> resolve_failed_cursor( conn, cursor, 1 )
+    0
+    """
+    offset = cursor['offset']
+    anchors = cursor.get( 'anchors', [] )
+    failed_key = f'{RQ_QUEUE_KEY_PREFIX}failed'
+    if not anchors:
+        return offset if offset <= failed_length else 0
+    ## is the newest anchor where it was? -----------------------------
+    ( newest_position, newest_job_id ) = anchors[0]
+    if decode_redis_value( redis_conn.lindex(failed_key, newest_position) ) == newest_job_id:
+        return offset
+    ## page backwards, looking for the newest surviving anchor ------
+    anchor_job_ids = { job_id for ( _, job_id ) in anchors }
+    page_end = min( offset, failed_length ) - 1
+    search_floor = max( 0, page_end + 1 - FAILED_CURSOR_SEARCH_LIMIT )
+    while page_end >= search_floor:
+        page_start = max( search_floor, page_end + 1 - FAILED_CURSOR_SEARCH_PAGE_SIZE )
+        job_ids = [ decode_redis_value(job_id) for job_id in redis_conn.lrange(failed_key, page_start, page_end) ]
+        for index in range( len(job_ids) - 1, -1, -1 ):
+            if job_ids[index] in anchor_job_ids:
+                log.info( f'failed list changed before the cursor; resuming after anchor ``{job_ids[index]}``, now at ``{page_start + index}``' )
+                return page_start + index + 1
+        page_end = page_start - 1
+    ## no anchor found ----------------------------------------------
+    position = 0 if failed_length <= FAILED_CURSOR_SEARCH_LIMIT else min( offset, failed_length )
+    log.warning( f'failed-job cursor anchors not found; failed list length ``{failed_length}``; resuming at ``{position}``' )
+    return position
+
+
+def parse_job_function( description ):
+    """ Returns the function-name from an rq job-description like `app.tasks.send(id=3)`.
+        Called by analyze_failed_jobs()
+    >>> parse_job_function( "app.tasks.send('a', b=2)" ), parse_job_function( None )
+    ('app.tasks.send', '(unknown)')
+    """
+    if not description:
+        return '(unknown)'
+    return description.split( '(', 1 )[0].strip()
+
+
+def parse_exception_class( exc_info ):
+    """ Returns the exception class from a job's traceback text -- the part before the colon on its last line.
+        Called by analyze_failed_jobs()
+    >>> parse_exception_class( 'Traceback (most recent call last):\\n  File "x.py", line 1\\nKeyError: 3\\n' )
+    'KeyError'
+    >>> parse_exception_class( '' )
+    '(unknown)'
+    """
+    lines = [ line for line in (exc_info or '').splitlines() if line.strip() ]
+    if not lines:
+        return '(unknown)'
+    return lines[-1].split( ':', 1 )[0].strip()
+
+
+def format_failure_groups( failure_groups ):
+    """ Returns failure-groups as email lines.
+        Called by build_email_message()
+    >>> print( format_failure_groups({'scanned': 7, 'remaining': 0, 'groups': [{'function': 'a.f', 'exception': 'KeyError', 'origin': 'q1', 'count': 7}]}) )
+    7 new failed jobs:
+    - 7 x a.f -- KeyError (queue q1)
+    """
+    if not failure_groups:
+        return '(not analyzed)'
+    lines = [ f'{failure_groups["scanned"]} new failed jobs' + (f' ({failure_groups["remaining"]} more not yet read)' if failure_groups['remaining'] else '') + ':' ]
+    lines.extend(
+        f'- {group["count"]} x {group["function"]} -- {group["exception"]} (queue {group["origin"]})' for group in failure_groups['groups'] )
+    return '\n'.join( lines )
+
+
+def save_rqinfo_data( data_dct, file_path=STATE_FILE_PATH ):
+    """ Saves rqinfo data to file, atomically -- a crash mid-write leaves the previous file intact.
+        Called by check_rqinfo_data() """
     assert type(data_dct) == dict
-    jsn = json.dumps( data_dct, sort_keys=True, indent=2 )
+    content: bytes = encode_state( data_dct, STATE_FORMAT )
     ## assume unicorns exist ------------------------------------------
-    file_path = '../previous_rqinfo_data/previous_rqinfo_data.json'
     try:
-        with open( file_path, 'w' ) as f:
-            f.write( jsn )
+        write_file_atomically( file_path, content )
     ## only acknowledge unhappiness if necessary ----------------------
     except FileNotFoundError:
         os.makedirs( os.path.dirname(file_path), exist_ok=True )
-        with open( file_path, 'w' ) as f:
-            f.write( jsn )
+        write_file_atomically( file_path, content )
     except Exception as e:
         log.exception( 'problem saving rqinfo data; traceback follows' )
         raise Exception( f'problem saving rqinfo data; error, ``{repr(e)}``' )
@@ -186,10 +1333,949 @@ def save_rqinfo_data( data_dct ):
     return
 
 
-def evaluate_qdata( previous_failed_count, expectations, data_dct ):
+## state-file encoding ----------------------------------------------
+##
+## State-files start with a header-line naming the format and the crc32 of the payload, so truncation or corruption is detected on load.
+## Files without a header (written by older versions of this script) are read as plain json.
+
+STATE_HEADERS = { 'json': b'QCHKR-JSON-1', 'binary': b'QCHKR-MARSHAL-1' }
+
+
+class StateFileCorruptError( Exception ):
+    """ Raised when a state-file fails its checksum or can't be decoded. """
+    pass
+
+
+def encode_state( data, state_format='json' ):
+    """
+    Returns header-line plus payload bytes; 'json' is compact (no indentation or key-sorting), 'binary' is marshal.
+    Called by save_rqinfo_data()
+
+    >>> encode_state( {'failed_count': 3}, 'json' )
+    b'QCHKR-JSON-1 83ce7708\\n{"failed_count":3}'
+    >>> decode_state( encode_state({'failed_count': 3, 'queues': ['q1']}, 'binary') )
+    {'failed_count': 3, 'queues': ['q1']}
+    >>> decode_state( b'{"failed_count": 3}' )  # legacy, header-less json
+    {'failed_count': 3}
+    >>> decode_state( encode_state({'failed_count': 3}, 'json')[:-2] )
+    Traceback (most recent call last):
+    ...
+    queue_check.StateFileCorruptError: checksum mismatch; expected ``83ce7708``, found ``203c6c4c``
+    """
+    if state_format == 'binary':
+        payload = marshal.dumps( data )
+    else:
+        payload = json.dumps( data, separators=(',', ':') ).encode( 'utf-8' )
+    header = STATE_HEADERS[state_format] + b' ' + f'{zlib.crc32(payload):08x}'.encode() + b'\n'
+    return header + payload
+
+
+def decode_state( content ):
+    """ Returns the dict encoded by encode_state(); raises StateFileCorruptError on a bad checksum or undecodable payload.
+        Called by load_previous_rqinfo_data() """
+    assert type(content) == bytes
+    try:
+        if not content.startswith( b'QCHKR-' ):
+            data = json.loads( content.decode('utf-8') )
+        else:
+            ( header, payload ) = content.split( b'\n', 1 )
+            ( format_label, expected_crc ) = header.decode( 'utf-8' ).split()
+            found_crc = f'{zlib.crc32(payload):08x}'
+            if found_crc != expected_crc:
+                raise StateFileCorruptError( f'checksum mismatch; expected ``{expected_crc}``, found ``{found_crc}``' )
+            if format_label == STATE_HEADERS['binary'].decode():
+                data = marshal.loads( payload )
+            else:
+                data = json.loads( payload.decode('utf-8') )
+    except StateFileCorruptError:
+        raise
+    except Exception as e:
+        raise StateFileCorruptError( f'undecodable state; err, ``{repr(e)}``' )
+    if type(data) != dict:
+        raise StateFileCorruptError( f'state is a ``{type(data)}``, not a dict' )
+    return data
+
+
+def write_file_atomically( file_path, content ):
+    """ Writes content to a temp-file in the same directory, fsyncs it, then renames it over file_path.
+        - The rename is atomic, so readers see either the old file or the new one, never a partial write.
+        - Fsyncs (of the file, and of the directory after the rename) can be turned off with `QCHKR__STATE_FSYNC=false`.
+        Called by save_rqinfo_data() """
+    dir_path = os.path.dirname( file_path ) or '.'
+    ( fd, temp_path ) = tempfile.mkstemp( dir=dir_path, prefix=f'.{os.path.basename(file_path)}.' )
+    try:
+        with os.fdopen( fd, 'wb' ) as f:
+            f.write( content )
+            f.flush()
+            if STATE_FSYNC:
+                os.fsync( f.fileno() )
+        os.replace( temp_path, file_path )
+    except BaseException:
+        try:
+            os.unlink( temp_path )
+        except OSError:
+            pass
+        raise
+    if STATE_FSYNC:
+        dir_fd = os.open( dir_path, os.O_RDONLY )
+        try:
+            os.fsync( dir_fd )
+        finally:
+            os.close( dir_fd )
+    return
+
+
+## history store ---------------------------------------------------
+##
+## An append-only sqlite time-series of every check's samples.
+## Rows are keyed (host, ts) and (host, queue, ts), so "the sample at or before time t" is an index-seek, not a scan.
+## Old samples are downsampled to one per bucket, and samples past the retention period are dropped.
+## Each queue's lengths and oldest-job waits also go into per-hour quantile sketches, which keep percentiles answerable
+##   after the samples behind them are downsampled.
+
+HISTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS samples (
+    host TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    failed_count INTEGER NOT NULL,
+    PRIMARY KEY ( host, ts ) ) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS queue_samples (
+    host TEXT NOT NULL,
+    queue TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    length INTEGER,
+    worker_count INTEGER NOT NULL,
+    busy_count INTEGER,
+    PRIMARY KEY ( host, queue, ts ) ) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS queue_sketch_bins (
+    host TEXT NOT NULL,
+    queue TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    bucket_ts INTEGER NOT NULL,
+    bin INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY ( queue, metric, bucket_ts, host, bin ) ) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS failure_baselines (
+    host TEXT NOT NULL,
+    slot INTEGER NOT NULL,
+    mean REAL NOT NULL,
+    variance REAL NOT NULL,
+    samples INTEGER NOT NULL,
+    PRIMARY KEY ( host, slot ) ) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL );
+'''
+
+
+def open_history( db_path ):
+    """ Opens (creating if necessary) the history database; returns a sqlite3 connection.
+        Called by check_rqinfo_data() """
+    history_conn = sqlite3.connect( db_path, timeout=30 )
+    history_conn.execute( 'PRAGMA journal_mode=WAL' )  # readers don't block the writer; fleet threads share the file
+    history_conn.execute( 'PRAGMA synchronous=NORMAL' )
+    history_conn.executescript( HISTORY_SCHEMA )
+    queue_sample_columns = [ row[1] for row in history_conn.execute('PRAGMA table_info(queue_samples)') ]
+    if 'busy_count' not in queue_sample_columns:  # history written before busy-counts were kept
+        try:
+            history_conn.execute( 'ALTER TABLE queue_samples ADD COLUMN busy_count INTEGER' )
+        except sqlite3.OperationalError as e:
+            if 'duplicate column name' not in str( e ):
+                raise
+            log.debug( 'busy_count column already added by another fleet thread' )
+    return history_conn
+
+
+def append_history_sample( history_conn, host_name, data_dct, ts ):
+    """ Appends one check's failed-count, and each queue's length, worker-count and busy-worker-count, to the history.
+        Called by check_rqinfo_data() """
+    queue_lengths = data_dct.get( 'queue_lengths', {} )
+    queue_utilization = compute_queue_utilization( data_dct )
+    queue_rows = [
+        ( host_name, queue_name, ts, queue_lengths.get(queue_name), queue_utilization[queue_name]['total'], queue_utilization[queue_name]['busy'] )
+        for queue_name in data_dct['queues'] ]
+    with history_conn:
+        history_conn.execute( 'INSERT OR REPLACE INTO samples VALUES ( ?, ?, ? )', (host_name, ts, data_dct['failed_count']) )
+        history_conn.executemany(
+            'INSERT OR REPLACE INTO queue_samples ( host, queue, ts, length, worker_count, busy_count ) VALUES ( ?, ?, ?, ?, ?, ? )', queue_rows )
+    return
+
+
+def get_history_sample_at( history_conn, host_name, ts ):
+    """
+    Returns the latest sample at-or-before `ts` -- eg "the failed count 1 hour ago" -- as a dict, or None if there isn't one.
+    Called by evaluation code needing older samples.
+
+    >>> history_conn = open_history( ':memory:' )
+    >>> for (ts, failed_count) in [ (1000, 5), (1060, 7), (1120, 30) ]:
+    ...     append_history_sample( history_conn, 'h1', {'failed_count': failed_count, 'queues': ['q1'], 'workers_by_queue': {'q1': ['w.1']}, 'queue_lengths': {'q1': ts - 1000}}, ts )
+    >>> get_history_sample_at( history_conn, 'h1', 1100 )
+    {'ts': 1060, 'failed_count': 7}
+    >>> get_history_sample_at( history_conn, 'h1', 999 ) is None
+    True
+    >>> get_queue_history( history_conn, 'h1', 'q1', since_ts=1060 )
+    [{'ts': 1060, 'length': 60, 'worker_count': 1, 'busy_count': None}, {'ts': 1120, 'length': 120, 'worker_count': 1, 'busy_count': None}]
+    """
+    row = history_conn.execute(
+        'SELECT ts, failed_count FROM samples WHERE host = ? AND ts <= ? ORDER BY ts DESC LIMIT 1', (host_name, ts) ).fetchone()
+    if row is None:
+        return None
+    return { 'ts': row[0], 'failed_count': row[1] }
+
+
+def get_queue_history( history_conn, host_name, queue_name, since_ts ):
+    """ Returns a queue's samples from `since_ts` onwards, oldest first.
+        Called by evaluation code needing queue trends. """
+    rows = history_conn.execute(
+        'SELECT ts, length, worker_count, busy_count FROM queue_samples WHERE host = ? AND queue = ? AND ts >= ? ORDER BY ts',
+        (host_name, queue_name, since_ts) ).fetchall()
+    return [
+        {'ts': ts, 'length': length, 'worker_count': worker_count, 'busy_count': busy_count} for (ts, length, worker_count, busy_count) in rows ]
+
+
+def get_previous_queue_sample( history_conn, host_name, before_ts ):
+    """
+    Returns the host's most recent sample before `before_ts`, as {'ts': ts, 'lengths': {queue: length}}, or None.
+    One indexed lookup for the sample-time, one for its queue-rows.
+    Called by check_rqinfo_data()
+
+    >>> history_conn = open_history( ':memory:' )
+    >>> append_history_sample( history_conn, 'h1', {'failed_count': 0, 'queues': ['q1', 'q2'], 'workers_by_queue': {}, 'queue_lengths': {'q1': 4, 'q2': 0}}, 1000 )
+    >>> get_previous_queue_sample( history_conn, 'h1', 1060 )
+    {'ts': 1000, 'lengths': {'q1': 4, 'q2': 0}}
+    >>> get_previous_queue_sample( history_conn, 'h1', 1000 ) is None
+    True
+    """
+    row = history_conn.execute( 'SELECT MAX(ts) FROM samples WHERE host = ? AND ts < ?', (host_name, before_ts) ).fetchone()
+    if row[0] is None:
+        return None
+    previous_ts = row[0]
+    queue_rows = history_conn.execute(
+        'SELECT queue, length FROM queue_samples WHERE host = ? AND ts = ?', (host_name, previous_ts) ).fetchall()
+    return { 'ts': previous_ts, 'lengths': { queue: length for (queue, length) in queue_rows if length is not None } }
+
+
+def get_queue_sample_at( history_conn, host_name, queue_name, ts ):
+    """ Returns a queue's latest sample at-or-before `ts`, as a dict, or None.
+        Called by compute_queue_trends()
+    >>> history_conn = open_history( ':memory:' )
+    >>> for ts in ( 1000, 1060, 1120 ):
+    ...     append_history_sample( history_conn, 'h1', {'failed_count': 0, 'queues': ['q1'], 'workers_by_queue': {}, 'queue_lengths': {'q1': ts - 1000}}, ts )
+    >>> get_queue_sample_at( history_conn, 'h1', 'q1', 1100 )
+    {'ts': 1060, 'length': 60}
+    """
+    row = history_conn.execute(
+        'SELECT ts, length FROM queue_samples WHERE host = ? AND queue = ? AND ts <= ? ORDER BY ts DESC LIMIT 1',
+        (host_name, queue_name, ts) ).fetchone()
+    if row is None:
+        return None
+    return { 'ts': row[0], 'length': row[1] }
+
+
+def prune_history( history_conn, now_ts, retention_days=None, downsample_after_days=None, downsample_seconds=None ):
+    """
+    Drops samples older than the retention period, and thins samples older than the downsample-age to the last one per bucket.
+    Does the work at most once per downsample-bucket, so frequent checks don't pay for it every run.
+    Called by check_rqinfo_data()
+
+    >>> history_conn = open_history( ':memory:' )
+    >>> day = 24 * 60 * 60
+    >>> for ts in range( 0, 10 * day, 600 ):  # a sample every 10 minutes, for 10 days
+    ...     append_history_sample( history_conn, 'h1', {'failed_count': 0, 'queues': [], 'workers_by_queue': {}}, ts )
+    >>> prune_history( history_conn, 10 * day, retention_days=9, downsample_after_days=2, downsample_seconds=3600 )
+    >>> history_conn.execute( 'SELECT COUNT(*), MIN(ts) FROM samples' ).fetchone()  # 7 days hourly, plus 2 days every 10 minutes
+    (456, 89400)
+    """
+    retention_days = HISTORY_RETENTION_DAYS if retention_days is None else retention_days
+    downsample_after_days = HISTORY_DOWNSAMPLE_AFTER_DAYS if downsample_after_days is None else downsample_after_days
+    downsample_seconds = HISTORY_DOWNSAMPLE_SECONDS if downsample_seconds is None else downsample_seconds
+    ## skip if already pruned during this bucket --------------------
+    row = history_conn.execute( "SELECT value FROM meta WHERE key = 'last_prune_ts'" ).fetchone()
+    if row is not None and ( int(row[0]) // downsample_seconds ) == ( now_ts // downsample_seconds ):
+        return
+    retention_cutoff = now_ts - int( retention_days * 24 * 60 * 60 )
+    downsample_cutoff = now_ts - int( downsample_after_days * 24 * 60 * 60 )
+    with history_conn:
+        ## drop expired samples -------------------------------------
+        history_conn.execute( 'DELETE FROM samples WHERE ts < ?', (retention_cutoff,) )
+        history_conn.execute( 'DELETE FROM queue_samples WHERE ts < ?', (retention_cutoff,) )
+        history_conn.execute( 'DELETE FROM queue_sketch_bins WHERE bucket_ts < ?', (retention_cutoff,) )
+        ## downsample old samples -----------------------------------
+        history_conn.execute( '''
+            DELETE FROM samples WHERE ts < :cutoff AND ( host, ts ) NOT IN (
+                SELECT host, MAX(ts) FROM samples WHERE ts < :cutoff GROUP BY host, ts / :bucket )''',
+            {'cutoff': downsample_cutoff, 'bucket': downsample_seconds} )
+        history_conn.execute( '''
+            DELETE FROM queue_samples WHERE ts < :cutoff AND ( host, queue, ts ) NOT IN (
+                SELECT host, queue, MAX(ts) FROM queue_samples WHERE ts < :cutoff GROUP BY host, queue, ts / :bucket )''',
+            {'cutoff': downsample_cutoff, 'bucket': downsample_seconds} )
+        history_conn.execute( "INSERT OR REPLACE INTO meta VALUES ( 'last_prune_ts', ? )", (str(now_ts),) )
+    log.debug( 'history pruned' )
+    return
+
+
+## quantile sketches ------------------------------------------------
+##
+## DDSketch-style sketches: values are counted in logarithmic bins, so any quantile is returned within a fixed
+##   relative error (1%), and two sketches merge by adding their bin-counts -- across hours, or across hosts.
+## A queue-length sketch spanning 0 to 1,000,000 jobs needs at most about 700 bins; usually far fewer.
+## The history keeps the bin-counts as rows, per queue, metric, hour and host; so adding a value is one upsert,
+##   and merging sketches is a SUM ... GROUP BY bin.
+
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_BUCKET_SECONDS = 3600
+SKETCH_METRICS = ( 'length', 'wait_seconds' )
+
+
+class QuantileSketch:
+    """ A mergeable quantile sketch, with relative accuracy `SKETCH_RELATIVE_ACCURACY`.
+    >>> sketch = QuantileSketch()
+    >>> for value in range( 0, 1001 ):
+    ...     sketch.add( value )
+    >>> sketch.count, abs( sketch.quantile(0.99) - 990 ) <= 990 * SKETCH_RELATIVE_ACCURACY, sketch.quantile( 0 )
+    (1001, True, 0)
+    >>> other = QuantileSketch.from_json( QuantileSketch().to_json() )
+    >>> other.add( 5000 )
+    >>> sketch.merge( other )
+    >>> sketch.count, abs( sketch.quantile(1) - 5000 ) <= 5000 * SKETCH_RELATIVE_ACCURACY
+    (1002, True)
+    """
+
+    gamma = ( 1 + SKETCH_RELATIVE_ACCURACY ) / ( 1 - SKETCH_RELATIVE_ACCURACY )
+    log_gamma = math.log( gamma )
+
+    def __init__( self ):
+        self.bins = {}  # bin-index -> count; bin i holds values in ( gamma ** (i-1), gamma ** i ]
+        self.zero_count = 0  # values of zero or less
+        self.count = 0
+
+    ZERO_BIN = -2 ** 31  # how zero-counts are stored in the history's bin-rows
+
+    @classmethod
+    def bin_index( cls, value ):
+        """ Returns the bin for a value; ZERO_BIN for zero or less. """
+        if value <= 0:
+            return cls.ZERO_BIN
+        return math.ceil( math.log(value) / cls.log_gamma )
+
+    def add( self, value, count=1 ):
+        self.add_to_bin( self.bin_index(value), count )
+
+    def add_to_bin( self, index, count ):
+        if index == self.ZERO_BIN:
+            self.zero_count += count
+        else:
+            self.bins[index] = self.bins.get( index, 0 ) + count
+        self.count += count
+
+    def merge( self, other ):
+        for ( index, count ) in other.bins.items():
+            self.bins[index] = self.bins.get( index, 0 ) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def quantile( self, fraction ):
+        """ Returns the value at the given quantile (0 to 1), or None if the sketch is empty. """
+        if self.count == 0:
+            return None
+        rank = fraction * ( self.count - 1 )
+        if rank < self.zero_count:
+            return 0
+        cumulative = self.zero_count
+        for index in sorted( self.bins ):
+            cumulative += self.bins[index]
+            if cumulative > rank:
+                return 2 * self.gamma ** index / ( self.gamma + 1 )  # the bin's midpoint, in relative terms
+        return 2 * self.gamma ** max( self.bins ) / ( self.gamma + 1 )
+
+    def to_json( self ):
+        return json.dumps( {'zero_count': self.zero_count, 'bins': sorted(self.bins.items())}, separators=(',', ':') )
+
+    @classmethod
+    def from_json( cls, jsn ):
+        data = json.loads( jsn )
+        sketch = cls()
+        for ( index, count ) in data['bins']:
+            sketch.add_to_bin( index, count )
+        sketch.add_to_bin( cls.ZERO_BIN, data['zero_count'] )
+        return sketch
+
+
+def update_queue_sketches( history_conn, host_name, data_dct, ts ):
+    """ Adds each queue's length, and (where sampled) its oldest job's wait, to the queue's sketches for the current hour.
+        One batch of upserts, each incrementing one bin-count.
+        Called by check_rqinfo_data() """
+    bucket_ts = ts - ts % SKETCH_BUCKET_SECONDS
+    wait_times = data_dct.get( 'queue_wait_times', {} )
+    bin_index = QuantileSketch.bin_index
+    rows = []
+    for ( queue_name, length ) in data_dct.get( 'queue_lengths', {} ).items():
+        rows.append( (host_name, queue_name, 'length', bucket_ts, bin_index(length)) )
+        if queue_name in wait_times:
+            rows.append( (host_name, queue_name, 'wait_seconds', bucket_ts, bin_index(wait_times[queue_name]['max_seconds'])) )
+    with history_conn:
+        history_conn.executemany( '''
+            INSERT INTO queue_sketch_bins VALUES ( ?, ?, ?, ?, ?, 1 )
+            ON CONFLICT ( queue, metric, bucket_ts, host, bin ) DO UPDATE SET count = count + 1''', rows )
+    return
+
+
+def get_queue_sketch( history_conn, queue_name, metric, since_ts, until_ts=None, host_name=None ):
+    """
+    Returns one sketch merging a queue's hourly sketches from `since_ts` (rounded down to the hour) to `until_ts`
+      -- for one host, or, with no host given, for every host sharing the history-database (a fleet-wide view).
+    Sketches from separate databases merge with QuantileSketch.merge(), after a to_json() / from_json() trip.
+    Called by callers wanting long-range percentiles, eg "p99 queue-length over the last 7 days"; see the readme.
+
+    >>> history_conn = open_history( ':memory:' )
+    >>> for ( host_name, offset ) in ( ('h1', 0), ('h2', 100) ):
+    ...     for ts in range( 0, 7 * 24 * 3600, 600 ):
+    ...         update_queue_sketches( history_conn, host_name, {'queue_lengths': {'q1': offset + (ts // 600) % 100}}, ts )
+    >>> sketch = get_queue_sketch( history_conn, 'q1', 'length', since_ts=0 )
+    >>> sketch.count, round( sketch.quantile(0.99) ), round( get_queue_sketch(history_conn, 'q1', 'length', 0, host_name='h1').quantile(0.99) )
+    (2016, 198, 99)
+    """
+    query = 'SELECT bin, SUM(count) FROM queue_sketch_bins WHERE queue = ? AND metric = ? AND bucket_ts >= ? AND bucket_ts <= ?'
+    parameters = [ queue_name, metric, since_ts - since_ts % SKETCH_BUCKET_SECONDS, until_ts if until_ts is not None else 2 ** 62 ]
+    if host_name is not None:
+        query += ' AND host = ?'
+        parameters.append( host_name )
+    merged_sketch = QuantileSketch()
+    for ( index, count ) in history_conn.execute( query + ' GROUP BY bin', parameters ):
+        merged_sketch.add_to_bin( index, count )
+    return merged_sketch
+
+
+## failure-surge baselines -----------------------------------------
+##
+## What's a normal failure-rate depends on the queue-load, which depends on the time of week. So for each host the history
+##   keeps an exponentially-weighted mean and variance of failures-per-minute for each hour-of-week (168 slots),
+##   plus one overall. Each check reads and updates two rows -- constant work, however long the history.
+## A check is a surge when its failure-rate is more than `surge_sigma` standard deviations above its slot's mean
+##   (the overall baseline stands in while the slot warms up; the fixed `surge_failure_limit` while both do).
+
+OVERALL_BASELINE_SLOT = -1
+BASELINE_SLOT_ALPHA = 0.1  # each hour-of-week slot is only updated during that hour, so it adapts faster
+BASELINE_OVERALL_ALPHA = 0.02
+BASELINE_WARMUP_SAMPLES = 30
+DEFAULT_SURGE_SIGMA = 4
+BASELINE_MIN_STDDEV = 0.5  # failures per minute; keeps a quiet slot's limit above its mean, so it can adapt
+BASELINE_SOURCE_LABELS = { 'hour_of_week': 'for this hour-of-week', 'overall': 'overall' }
+DEFAULT_SURGE_MIN_FAILURES = 5  # below this many new failures, nothing is a surge; keeps near-zero variance from being noisy
+
+
+def get_hour_of_week( ts ):
+    """ Returns 0 (Monday, midnight to 1am, local time) to 167.
+        Called by update_failure_baseline()
+    >>> get_hour_of_week( datetime.datetime(2024, 1, 1, 0, 30).timestamp() ), get_hour_of_week( datetime.datetime(2024, 1, 7, 23, 30).timestamp() )
+    (0, 167)
+    """
+    local_time = datetime.datetime.fromtimestamp( ts )
+    return local_time.weekday() * 24 + local_time.hour
+
+
+def update_failure_baseline( history_conn, host_name, previous_sample, failed_count, now_ts, expectations_dct ):
+    """
+    Returns the failure-baseline a check is judged against -- the check's failure-rate, and the mean and standard-deviation
+      from the hour-of-week slot (or the overall baseline, while the slot warms up) -- then folds the check into both baselines.
+    Returns None with no previous sample, or when both baselines are still warming up (so the fixed limit applies),
+      or when `adaptive_surge` is turned off in the expectations.
+    A check that's a surge (see list_adaptive_surge_violations()) is clipped to the alert-threshold before being folded in,
+      so one outage doesn't raise the baseline much; other checks are folded in as they are.
+    The standard-deviation has a floor of `BASELINE_MIN_STDDEV`, so a slot that's been quiet (zero variance) can still learn a higher rate.
+    Called by check_rqinfo_data()
+
+    >>> history_conn = open_history( ':memory:' )
+    >>> ts = datetime.datetime( 2024, 1, 1, 9, 0 ).timestamp()
+    >>> failed_count = 0
+    >>> for minute in range( 40 ):  # 2 or 4 failures a minute
+    ...     baseline = update_failure_baseline( history_conn, 'h1', {'ts': ts, 'failed_count': failed_count}, failed_count + 2 + 2 * (minute % 2), ts + 60, {} )
+    ...     ( ts, failed_count ) = ( ts + 60, failed_count + 2 + 2 * (minute % 2) )
+    >>> baseline['source'], round( baseline['mean'], 1 ), round( baseline['stddev'], 1 )
+    ('hour_of_week', 2.9, 1.0)
+    >>> update_failure_baseline( history_conn, 'h1', {'ts': ts, 'failed_count': failed_count}, failed_count + 40, ts + 60, {} )['rate_per_minute']
+    40.0
+
+    A quiet warm-up, then a steady 3 failures a minute -- under `surge_min_failures`, so never a surge -- is learned:
+    >>> history_conn = open_history( ':memory:' )
+    >>> ( ts, failed_count ) = ( datetime.datetime( 2024, 1, 1, 9, 0 ).timestamp(), 0 )
+    >>> for minute in range( 100 ):
+    ...     increase = 0 if minute < 40 else 3
+    ...     baseline = update_failure_baseline( history_conn, 'h1', {'ts': ts, 'failed_count': failed_count}, failed_count + increase, ts + 60, {} )
+    ...     ( ts, failed_count ) = ( ts + 60, failed_count + increase )
+    >>> round( baseline['mean'], 1 ), baseline['stddev'] >= BASELINE_MIN_STDDEV
+    (3.0, True)
+    """
+    if previous_sample is None or not expectations_dct.get( 'adaptive_surge', True ) or now_ts <= previous_sample['ts']:
+        return None
+    rate_per_minute = max( 0, failed_count - previous_sample['failed_count'] ) / ( (now_ts - previous_sample['ts']) / 60 )
+    slot = get_hour_of_week( now_ts )
+    rows = {
+        row_slot: { 'mean': mean, 'variance': variance, 'samples': samples } for ( row_slot, mean, variance, samples ) in history_conn.execute(
+            'SELECT slot, mean, variance, samples FROM failure_baselines WHERE host = ? AND slot IN ( ?, ? )', (host_name, slot, OVERALL_BASELINE_SLOT) ) }
+    ## pick the baseline to judge against -----------------------------
+    baseline = None
+    for ( row_slot, source ) in ( (slot, 'hour_of_week'), (OVERALL_BASELINE_SLOT, 'overall') ):
+        row = rows.get( row_slot )
+        if row is not None and row['samples'] >= BASELINE_WARMUP_SAMPLES:
+            baseline = {
+                'source': source, 'rate_per_minute': round( rate_per_minute, 2 ), 'mean': row['mean'],
+                'stddev': max( math.sqrt(row['variance']), BASELINE_MIN_STDDEV ), 'samples': row['samples'] }
+            break
+    ## fold this check in ---------------------------------------------
+    update_value = rate_per_minute
+    failure_increase = max( 0, failed_count - previous_sample['failed_count'] )
+    if baseline is not None and list_adaptive_surge_violations( expectations_dct, failure_increase, baseline ):
+        surge_sigma = expectations_dct.get( 'surge_sigma', DEFAULT_SURGE_SIGMA )
+        update_value = baseline['mean'] + surge_sigma * baseline['stddev']
+    updated_rows = []
+    for ( row_slot, alpha ) in ( (slot, BASELINE_SLOT_ALPHA), (OVERALL_BASELINE_SLOT, BASELINE_OVERALL_ALPHA) ):
+        row = rows.get( row_slot )
+        if row is None:
+            ( mean, variance, samples ) = ( update_value, 0.0, 1 )
+        else:
+            difference = update_value - row['mean']
+            increment = alpha * difference
+            ( mean, variance, samples ) = ( row['mean'] + increment, (1 - alpha) * (row['variance'] + difference * increment), row['samples'] + 1 )
+        updated_rows.append( (host_name, row_slot, mean, variance, samples) )
+    with history_conn:
+        history_conn.executemany( 'INSERT OR REPLACE INTO failure_baselines VALUES ( ?, ?, ?, ?, ? )', updated_rows )
+    log.debug( f'failure baseline, ``{baseline}``' )
+    return baseline
+
+
+## alert digests ----------------------------------------------------
+##
+## In digest mode, notifications from every host and check are batched, and sent as one message with a per-host table,
+##   coalescing identical problems across hosts.
+## A daemon keeps the batch open for `digest_seconds` (checked after each run); a run-once check sends its batch right away.
+
+alert_digest: dict = {
+    'windowed': False,  # set by run_daemon(); a run-once process can't hold a window open
+    'opened_at': None,  # monotonic time the current batch got its first notification
+    'results': [] }
+alert_digest_lock = threading.Lock()
+
+
+def add_to_digest( results ):
+    """ Adds check-results to the current digest-batch; opens the batch-window at the first notification.
+        Called by send_alerts() """
+    with alert_digest_lock:
+        alert_digest['results'].extend( results )
+        if alert_digest['opened_at'] is None and any( result['notifications'] for result in results ):
+            alert_digest['opened_at'] = time.monotonic()
+    return
+
+
+def flush_digest( force, digest_seconds=0 ):
+    """ Sends the batched notifications as one digest-message if the window has elapsed (or `force`), then starts a new batch.
+        Returns True if a digest was sent.
+        Called by send_alerts(), and by run_daemon() on shutdown. """
+    with alert_digest_lock:
+        opened_at = alert_digest['opened_at']
+        if opened_at is None:
+            alert_digest['results'] = []  # nothing to report; don't let ok-results pile up
+            return False
+        if not force and time.monotonic() - opened_at < digest_seconds:
+            return False
+        results = alert_digest['results']
+        alert_digest['results'] = []
+        alert_digest['opened_at'] = None
+    with timed_stage( 'email_build' ):
+        msg: str = build_digest_message( results )
+    with timed_stage( 'email_send' ):
+        deliver_alert( message=msg )
+    return True
+
+
+def build_digest_message( results ):
+    """
+    Assembles a digest: a table of each host's latest check-results, then every notification in the batch,
+      with identical problems on several hosts coalesced into one line.
+    Called by flush_digest()
+
+    >>> def result( host, worker_check, notifications ):
+    ...     return { 'host': host, 'evaluation_dct': {'queue_check': 'ok', 'worker_check': worker_check, 'failure_queue_check': 'ok'}, 'notifications': notifications }
+    >>> down = {'kind': 'new', 'key': 'x', 'detail': 'queue ``q1`` has 0 workers; expected 1'}
+    >>> print( build_digest_message([ result('server_a', 'FAIL', [down]), result('server_b', 'FAIL', [down]), result('server_c', 'ok', []) ]) )  # doctest: +NORMALIZE_WHITESPACE
+    <BLANKLINE>
+    DIGEST: 2 alert changes, 3 hosts -------------------------------------
+    <BLANKLINE>
+    host      queue_check  worker_check  failure_queue_check
+    server_a  ok           FAIL          ok
+    server_b  ok           FAIL          ok
+    server_c  ok           ok            ok
+    <BLANKLINE>
+    ALERT CHANGES -------------------------------------------------------
+    - NEW: queue ``q1`` has 0 workers; expected 1 -- on server_a, server_b
+    <BLANKLINE>
+    [END]
+    <BLANKLINE>
+    """
+    latest_by_host = {}
+    coalesced = {}  # ( kind, detail ) -> hosts
+    notification_count = 0
+    for result in results:
+        latest_by_host[result['host']] = result['evaluation_dct']
+        for notification in result['notifications']:
+            notification_count += 1
+            hosts = coalesced.setdefault( (notification['kind'], notification['detail']), [] )
+            if result['host'] not in hosts:
+                hosts.append( result['host'] )
+    check_names = list( OK_EVALUATION.keys() )
+    for evaluation_dct in latest_by_host.values():  # plus any optional checks, like backlog_check
+        check_names.extend( check_name for check_name in evaluation_dct if check_name not in check_names )
+    host_width = max( [len('host')] + [len(host) for host in latest_by_host] )
+    table_lines = [ '  '.join( ['host'.ljust(host_width)] + check_names ) ]
+    for ( host, evaluation_dct ) in latest_by_host.items():
+        cells = [ evaluation_dct.get(check_name, '-').ljust(len(check_name)) for check_name in check_names ]
+        table_lines.append( '  '.join([host.ljust(host_width)] + cells).rstrip() )
+    table = '\n'.join( table_lines )
+    change_lines = '\n'.join( f'- {kind.upper()}: {detail} -- on {", ".join(hosts)}' for ( (kind, detail), hosts ) in coalesced.items() )
+    msg = f'''
+DIGEST: {notification_count} alert changes, {len(latest_by_host)} hosts -------------------------------------
+
+{table}
+
+ALERT CHANGES -------------------------------------------------------
+{change_lines}
+
+[END]
+'''
+    log.debug( f'msg, ``{msg}``' )
+    return msg
+
+
+## alert-states -----------------------------------------------------
+##
+## Each violation is tracked by (host, check, queue), so an ongoing problem is emailed when it starts,
+##   again every `renotify_minutes` (an expectations setting; default 60; 0 re-notifies every check), and once when it resolves.
+
+DEFAULT_RENOTIFY_MINUTES = 60
+
+
+def track_alerts( host_name, violations, expectations_dct, state_file_path, now_ts, keep_unchecked=False ):
+    """ Loads the host's alert-states from beside its state-file, updates them with the current violations, saves them,
+          and returns the resulting notifications.
+        - `keep_unchecked` is for a host that couldn't be checked: its other alerts are kept as they are, not resolved.
+        Called by check_rqinfo_data() and check_fleet_host() """
+    alert_state_path = f'{os.path.splitext(state_file_path)[0]}__alerts.json'
+    alert_states = load_alert_states( alert_state_path )
+    renotify_seconds = int( expectations_dct.get('renotify_minutes', DEFAULT_RENOTIFY_MINUTES) * 60 )
+    ( alert_states, notifications ) = update_alert_states( alert_states, host_name, violations, now_ts, renotify_seconds, keep_unchecked )
+    content = encode_state( alert_states, 'json' )
+    try:
+        write_file_atomically( alert_state_path, content )
+    except FileNotFoundError:
+        os.makedirs( os.path.dirname(alert_state_path), exist_ok=True )
+        write_file_atomically( alert_state_path, content )
+    if log.isEnabledFor( logging.DEBUG ):
+        log.debug( f'notifications, ``{notifications}``' )
+    return notifications
+
+
+def load_alert_states( alert_state_path ):
+    """ Returns saved alert-states, or an empty dict if there are none.
+        A corrupt file is logged and replaced; the worst outcome is re-notifying of ongoing problems.
+        Called by track_alerts() """
+    try:
+        with open( alert_state_path, 'rb' ) as f:
+            alert_states = decode_state( f.read() )
+    except FileNotFoundError:
+        alert_states = {}
+    except StateFileCorruptError as e:
+        log.error( f'alert-states corrupt; err, ``{e}``; starting over' )
+        alert_states = {}
+    return alert_states
+
+
+def update_alert_states( alert_states, host_name, violations, now_ts, renotify_seconds, keep_unchecked=False ):
+    """
+    Applies one check's violations to the alert-states; returns the new states and a list of notifications:
+    - `new` when a (host, check, queue -- plus rule and worker, where a violation has them) starts failing,
+    - `reminder` when it's still failing and `renotify_seconds` have passed since the last notification,
+    - `resolved` when it stops failing.
+    With `keep_unchecked` (the host couldn't be checked, so its state is unknown), alerts without a current violation
+      are kept unchanged rather than resolved.
+    Called by track_alerts()
+
+    >>> violation = {'check': 'worker_check', 'queue': 'q1', 'expected': 1, 'actual': 0, 'detail': 'queue ``q1`` has 0 workers; expected 1'}
+    >>> ( states, notes ) = update_alert_states( {}, 'h1', [violation], now_ts=1000, renotify_seconds=3600 )
+    >>> [ (note['kind'], note['key']) for note in notes ]
+    [('new', 'h1::worker_check::q1')]
+    >>> ( states, notes ) = update_alert_states( states, 'h1', [violation], now_ts=1060, renotify_seconds=3600 )
+    >>> notes  # still failing; not yet due a reminder
+    []
+    >>> ( states, notes ) = update_alert_states( states, 'h1', [violation], now_ts=4600, renotify_seconds=3600 )
+    >>> [ note['kind'] for note in notes ]
+    ['reminder']
+    >>> ( states, notes ) = update_alert_states( states, 'h1', [], now_ts=4660, renotify_seconds=3600 )
+    >>> [ (note['kind'], note['detail']) for note in notes ], states
+    ([('resolved', 'queue ``q1`` has 0 workers; expected 1 (failing since 1000)')], {})
+    >>> ( states, notes ) = update_alert_states( {}, 'h1', [violation], now_ts=1000, renotify_seconds=3600 )
+    >>> collect_violation = {'check': 'collect_check', 'queue': None, 'expected': 'ok', 'actual': 'error', 'detail': 'problem checking host'}
+    >>> ( states, notes ) = update_alert_states( states, 'h1', [collect_violation], now_ts=1060, renotify_seconds=3600, keep_unchecked=True )
+    >>> [ (note['kind'], note['key']) for note in notes ], sorted( states )
+    ([('new', 'h1::collect_check::None')], ['h1::collect_check::None', 'h1::worker_check::q1'])
+    """
+    new_states = {}
+    notifications = []
+    for violation in violations:
+        key = f'{host_name}::{violation["check"]}::{violation["queue"]}'
+        for field in ( 'rule', 'worker' ):
+            if violation.get( field ):
+                key = f'{key}::{violation[field]}'
+        previous_state = alert_states.get( key )
+        if previous_state is None:
+            new_states[key] = { 'since': now_ts, 'last_notified': now_ts, 'detail': violation['detail'] }
+            notifications.append( {'kind': 'new', 'key': key, 'detail': violation['detail']} )
+        elif now_ts - previous_state['last_notified'] >= renotify_seconds:
+            new_states[key] = { **previous_state, 'last_notified': now_ts, 'detail': violation['detail'] }
+            notifications.append( {'kind': 'reminder', 'key': key, 'detail': f'{violation["detail"]} (failing since {previous_state["since"]})'} )
+        else:
+            new_states[key] = { **previous_state, 'detail': violation['detail'] }
+    for ( key, previous_state ) in alert_states.items():
+        if key in new_states:
+            continue
+        if keep_unchecked:
+            new_states[key] = previous_state
+        else:
+            notifications.append( {'kind': 'resolved', 'key': key, 'detail': f'{previous_state["detail"]} (failing since {previous_state["since"]})'} )
+    return ( new_states, notifications )
+
+
+## queue rates ------------------------------------------------------
+
+
+def compute_queue_rates( previous_queue_sample, queue_lengths, now_ts, drained_counts=None ):
+    """
+    Returns per-queue rates from two consecutive samples: net growth per minute, and the estimated minutes until the queue is empty.
+    - `drained_counts`, if known, is jobs taken off each queue between the samples; then the drain and enqueue rates are split out
+        (enqueued = growth + drained).
+    - Minutes-to-empty uses the net decline (drain minus enqueue), so new arrivals count against it;
+        only a shrinking queue has an estimate, and a steady or growing one with jobs waiting has None.
+    Called by check_rqinfo_data()
+
+    >>> previous = {'ts': 1000, 'lengths': {'q1': 100, 'q2': 10, 'q3': 5}}
+    >>> rates = compute_queue_rates( previous, {'q1': 70, 'q2': 40, 'q3': 0, 'new_q': 3}, 1060 )
+    >>> rates['q1']
+    {'length': 70, 'growth_per_minute': -30.0, 'enqueue_per_minute': None, 'drain_per_minute': None, 'minutes_to_empty': 2.3}
+    >>> rates['q2']['growth_per_minute'], rates['q2']['minutes_to_empty']
+    (30.0, None)
+    >>> rates['q3']['minutes_to_empty'], 'new_q' in rates
+    (0.0, False)
+    >>> compute_queue_rates( previous, {'q2': 40}, 1060, drained_counts={'q2': 60} )['q2']  # draining, but growing faster
+    {'length': 40, 'growth_per_minute': 30.0, 'enqueue_per_minute': 90.0, 'drain_per_minute': 60.0, 'minutes_to_empty': None}
+    >>> compute_queue_rates( None, {'q1': 1}, 1060 )
+    {}
+    """
+    queue_rates = {}
+    if previous_queue_sample is None or now_ts <= previous_queue_sample['ts']:
+        return queue_rates
+    elapsed_minutes = ( now_ts - previous_queue_sample['ts'] ) / 60
+    for ( queue_name, length ) in queue_lengths.items():
+        previous_length = previous_queue_sample['lengths'].get( queue_name )
+        if previous_length is None:
+            continue
+        growth_per_minute = ( length - previous_length ) / elapsed_minutes
+        drain_per_minute = None
+        enqueue_per_minute = None
+        if drained_counts is not None and queue_name in drained_counts:
+            drain_per_minute = drained_counts[queue_name] / elapsed_minutes
+            enqueue_per_minute = growth_per_minute + drain_per_minute
+        if length == 0:
+            minutes_to_empty = 0.0
+        elif growth_per_minute < 0:
+            minutes_to_empty = round( length / -growth_per_minute, 1 )
+        else:
+            minutes_to_empty = None
+        queue_rates[queue_name] = {
+            'length': length,
+            'growth_per_minute': round( growth_per_minute, 2 ),
+            'enqueue_per_minute': None if enqueue_per_minute is None else round( enqueue_per_minute, 2 ),
+            'drain_per_minute': None if drain_per_minute is None else round( drain_per_minute, 2 ),
+            'minutes_to_empty': minutes_to_empty }
+    return queue_rates
+
+
+DEFAULT_GROWTH_WINDOW_MINUTES = 5
+
+
+def compute_queue_trends( history_conn, host_name, expectations_dct, queue_lengths, queue_rates, now_ts, queue_utilization=None ):
+    """
+    Returns, for each queue with backlog rules, its growth per minute over the last `growth_window_minutes`
+      (an expectations setting; default 5) from the history -- steadier than check-to-check growth --
+      and its minutes-to-empty from the queue-rates.
+    Growth falls back to the check-to-check rate until the history reaches back a full window.
+    Also returns, for each queue with a busy-threshold (`max_busy_minutes`, top-level or in its `queue_rules`) whose workers
+      are all busy, how many minutes they've been all-busy.
+    Called by check_rqinfo_data()
+    >>> history_conn = open_history( ':memory:' )
+    >>> for ( ts, length ) in ( (1000, 10), (1300, 40) ):
+    ...     append_history_sample( history_conn, 'h1', {'failed_count': 0, 'queues': ['q1'], 'workers_by_queue': {}, 'queue_lengths': {'q1': length}}, ts )
+    >>> rates = {'q1': {'growth_per_minute': 30.0, 'minutes_to_empty': None}}
+    >>> compute_queue_trends( history_conn, 'h1', {'queue_rules': {'q1': {'max_growth_per_minute': 5}}}, {'q1': 40}, rates, 1300 )
+    {'q1': {'growth_per_minute': 6.0, 'minutes_to_empty': None}}
+    >>> data = {'failed_count': 0, 'queues': ['q1'], 'workers_by_queue': {'q1': ['w.1']}, 'queue_lengths': {'q1': 40}, 'worker_states': {'w.1': 'busy'}}
+    >>> for ts in ( 1600, 1900 ):
+    ...     append_history_sample( history_conn, 'h1', data, ts )
+    >>> compute_queue_trends( history_conn, 'h1', {'max_busy_minutes': 5}, {'q1': 40}, {}, 1900, compute_queue_utilization(data) )
+    {'q1': {'busy_minutes': 5.0}}
+    """
+    queue_rules = expectations_dct.get( 'queue_rules', {} )
+    queue_trends = {}
+    ## busy-minutes -------------------------------------------------
+    for ( queue_name, utilization ) in ( queue_utilization or {} ).items():
+        if get_queue_setting( expectations_dct, queue_name, 'max_busy_minutes' ) is None:
+            continue
+        if utilization['total'] and utilization['busy'] == utilization['total']:
+            all_busy_since = get_all_busy_since( history_conn, host_name, queue_name, now_ts )
+            queue_trends[queue_name] = { 'busy_minutes': round( (now_ts - all_busy_since) / 60, 1 ) }
+        else:
+            queue_trends[queue_name] = { 'busy_minutes': 0.0 }
+    ## growth -------------------------------------------------------
+    window_seconds = int( expectations_dct.get('growth_window_minutes', DEFAULT_GROWTH_WINDOW_MINUTES) * 60 )
+    for ( queue_name, rules ) in queue_rules.items():
+        if queue_name not in queue_lengths or not {'max_growth_per_minute', 'max_time_to_drain'} & set( rules ):
+            continue
+        queue_rate = queue_rates.get( queue_name, {} )
+        growth_per_minute = queue_rate.get( 'growth_per_minute' )
+        window_sample = get_queue_sample_at( history_conn, host_name, queue_name, now_ts - window_seconds )
+        if window_sample is not None and window_sample['length'] is not None and window_sample['ts'] < now_ts:
+            elapsed_minutes = ( now_ts - window_sample['ts'] ) / 60
+            growth_per_minute = round( (queue_lengths[queue_name] - window_sample['length']) / elapsed_minutes, 2 )
+        queue_trends.setdefault( queue_name, {} ).update( {
+            'growth_per_minute': growth_per_minute,
+            'minutes_to_empty': queue_rate.get( 'minutes_to_empty' ) } )
+    if log.isEnabledFor( logging.DEBUG ):
+        log.debug( f'queue_trends, ``{queue_trends}``' )
+    return queue_trends
+
+
+def get_queue_setting( expectations_dct, queue_name, setting_name ):
+    """ Returns a per-queue setting, like `max_busy_minutes` -- from the queue's `queue_rules`, else top-level -- or None.
+        Called by compute_queue_trends() and list_violations()
+    >>> get_queue_setting( {'max_busy_minutes': 10, 'queue_rules': {'q1': {'max_busy_minutes': 3}}}, 'q1', 'max_busy_minutes' )
+    3
+    >>> get_queue_setting( {'queue_rules': {'q1': {'max_length': 3}}}, 'q2', 'max_busy_minutes' ) is None
+    True
+    """
+    rules = expectations_dct.get( 'queue_rules', {} ).get( queue_name, {} )
+    return rules.get( setting_name, expectations_dct.get(setting_name) )
+
+
+def has_queue_setting( expectations_dct, setting_name ):
+    """ Returns True if a per-queue setting is set top-level or for any queue.
+        Called by summarize_violations() """
+    return setting_name in expectations_dct or any( setting_name in rules for rules in expectations_dct.get('queue_rules', {}).values() )
+
+
+DEFAULT_FAILURE_RATIO_MIN_JOBS = 20  # fewer jobs processed than this, and the failure-ratio is too noisy to alert on
+
+
+def compute_queue_job_counts( previous_workers, workers ):
+    """
+    Returns, per queue, the jobs its workers finished and failed since the previous check (from the workers'
+      `successful_job_count` and `failed_job_count`, read with the rest of the worker-hashes), and the failure-ratio.
+    - A worker listening on several queues counts towards each; rq doesn't record which queue a job came from.
+    - A count lower than before means the worker restarted, so the whole count is new; a new worker's counts are all new.
+    - Returns {} without worker details, now or at the previous check (the `rqinfo` path; the first direct read),
+        or where rq doesn't keep the counts.
+    Called by check_rqinfo_data()
+
+    >>> previous = {'w.1': {'queues': ['q1'], 'successful_job_count': 100, 'failed_job_count': 4}}
+    >>> current = {
+    ...     'w.1': {'queues': ['q1'], 'successful_job_count': 190, 'failed_job_count': 14},
+    ...     'w.2': {'queues': ['q1', 'q2'], 'successful_job_count': 10, 'failed_job_count': 0} }
+    >>> compute_queue_job_counts( previous, current )
+    {'q1': {'succeeded': 100, 'failed': 10, 'processed': 110, 'failure_ratio': 0.091}, 'q2': {'succeeded': 10, 'failed': 0, 'processed': 10, 'failure_ratio': 0.0}}
+    """
+    if not workers or previous_workers is None:
+        return {}
+    queue_job_counts = {}
+    for ( worker_name, worker ) in workers.items():
+        if worker.get( 'successful_job_count' ) is None or worker.get( 'failed_job_count' ) is None:
+            continue
+        previous_worker = previous_workers.get( worker_name, {} )
+        new_counts = []
+        for count_name in ( 'successful_job_count', 'failed_job_count' ):
+            ( count, previous_count ) = ( worker[count_name], previous_worker.get(count_name) )
+            new_counts.append( count if previous_count is None or count < previous_count else count - previous_count )
+        for queue_name in worker['queues']:
+            job_counts = queue_job_counts.setdefault( queue_name, {'succeeded': 0, 'failed': 0} )
+            job_counts['succeeded'] += new_counts[0]
+            job_counts['failed'] += new_counts[1]
+    for job_counts in queue_job_counts.values():
+        job_counts['processed'] = job_counts['succeeded'] + job_counts['failed']
+        job_counts['failure_ratio'] = round( job_counts['failed'] / job_counts['processed'], 3 ) if job_counts['processed'] else None
+    return queue_job_counts
+
+
+def get_drained_counts( queue_job_counts, workers ):
+    """ Returns, for queues whose workers all listen on that queue alone, the jobs processed since the previous check -- or None.
+        - A shared queue's processed-count includes jobs its workers took from their other queues, so it's left out,
+            and its drain and enqueue rates stay unknown rather than inflated.
+        Called by check_rqinfo_data()
+    >>> counts = {'q1': {'processed': 110}, 'q2': {'processed': 10}, 'q3': {'processed': 5}}
+    >>> workers = {'w.1': {'queues': ['q1']}, 'w.2': {'queues': ['q1', 'q2']}, 'w.3': {'queues': ['q3']}}
+    >>> get_drained_counts( counts, workers )
+    {'q3': 5}
+    >>> get_drained_counts( {}, None ) is None
+    True
+    """
+    shared_queue_names = { queue_name for worker in (workers or {}).values() if len(worker['queues']) > 1 for queue_name in worker['queues'] }
+    drained_counts = {
+        queue_name: job_counts['processed'] for ( queue_name, job_counts ) in queue_job_counts.items() if queue_name not in shared_queue_names }
+    return drained_counts or None
+
+
+## worker utilization -----------------------------------------------
+
+
+def compute_queue_utilization( data_dct ):
+    """ Returns each queue's busy and total worker-counts, and utilization (busy / total).
+        - busy and utilization are None where worker-states are unknown (state saved by older versions).
+        Called by append_history_sample(), compute_queue_trends() (via check_rqinfo_data()), and render_metrics()
+    >>> data = {'queues': ['q1', 'q2', 'q3'], 'workers_by_queue': {'q1': ['w.1', 'w.2'], 'q2': ['w.2'], 'q3': []},
+    ...     'worker_states': {'w.1': 'idle', 'w.2': 'busy'}}
+    >>> compute_queue_utilization( data )
+    {'q1': {'busy': 1, 'total': 2, 'utilization': 0.5}, 'q2': {'busy': 1, 'total': 1, 'utilization': 1.0}, 'q3': {'busy': 0, 'total': 0, 'utilization': None}}
+    """
+    worker_states = data_dct.get( 'worker_states' )
+    queue_utilization = {}
+    for queue_name in data_dct['queues']:
+        worker_names = data_dct['workers_by_queue'].get( queue_name, [] )
+        busy = None if worker_states is None else sum( 1 for name in worker_names if worker_states.get(name) == 'busy' )
+        queue_utilization[queue_name] = {
+            'busy': busy,
+            'total': len( worker_names ),
+            'utilization': round( busy / len(worker_names), 3 ) if ( busy is not None and worker_names ) else None }
+    return queue_utilization
+
+
+def get_all_busy_since( history_conn, host_name, queue_name, now_ts ):
+    """ Returns the ts of the first sample in the queue's current run of all-busy samples (through `now_ts`).
+        Called by compute_queue_trends()
+    >>> history_conn = open_history( ':memory:' )
+    >>> for ( ts, state ) in ( (1000, 'busy'), (1060, 'idle'), (1120, 'busy'), (1180, 'busy') ):
+    ...     data = {'failed_count': 0, 'queues': ['q1'], 'workers_by_queue': {'q1': ['w.1']}, 'worker_states': {'w.1': state}}
+    ...     append_history_sample( history_conn, 'h1', data, ts )
+    >>> get_all_busy_since( history_conn, 'h1', 'q1', 1180 )
+    1120
+    """
+    ( last_not_busy_ts, ) = history_conn.execute(
+        'SELECT MAX(ts) FROM queue_samples WHERE host = ? AND queue = ? AND ts <= ? AND NOT ( worker_count > 0 AND busy_count IS worker_count )',
+        (host_name, queue_name, now_ts) ).fetchone()
+    ( all_busy_since, ) = history_conn.execute(
+        'SELECT MIN(ts) FROM queue_samples WHERE host = ? AND queue = ? AND ts > ? AND ts <= ?',
+        (host_name, queue_name, -1 if last_not_busy_ts is None else last_not_busy_ts, now_ts) ).fetchone()
+    return now_ts if all_busy_since is None else all_busy_since
+
+
+def evaluate_qdata( previous_failed_count, expectations, data_dct, queue_trends=None ):
     """ 
     Evaluates rqinfo output against expectation-data.
-    Called by run_code()     
+    Returns the per-check ok/FAIL summary; for the full list of problems, see list_violations().
 
     Example -- all ok:
     >>> previous_failed_count = 10
@@ -207,60 +2293,280 @@ def evaluate_qdata( previous_failed_count, expectations, data_dct ):
     >>> result
     {'queue_check': 'FAIL', 'worker_check': 'FAIL', 'failure_queue_check': 'FAIL'}
     """
+    violations = list_violations( previous_failed_count, expectations, data_dct, queue_trends )
+    checks_result = summarize_violations( violations, expectations )
+    return checks_result
+    # end def evaluate_qdata()
+
+
+def list_violations( previous_failed_count, expectations, data_dct, queue_trends=None, failure_baseline=None ):
+    """ 
+    Checks every expectation, returning a list of all violations, each a dict of check, queue, expected, actual, and detail.
+    Builds a set of present queues once, so checking is linear in the number of expectations plus queues.
+    Per-queue backlog rules (`queue_rules` in expectations) use `queue_trends`, from compute_queue_trends().
+    With a warmed-up `failure_baseline`, from update_failure_baseline(), a failure-surge is judged against it
+      rather than against the fixed `surge_failure_limit`.
+    Called by evaluate_qdata() and check_rqinfo_data()
+
+    >>> expectations_data = {'expected_queues': ['q1', 'q2', 'q3'], 'expected_workers': [{'queue': 'q1', 'worker_count': 2}, {'queue': 'q2', 'worker_count': 1}], 'surge_failure_limit': 10}
+    >>> rqinfo_data = {'failed_count': 30, 'queues': ['q1', 'failed'], 'workers_by_queue': {'q1': ['server.123'], 'failed': []}}
+    >>> for violation in list_violations( 10, expectations_data, rqinfo_data ):
+    ...     print( violation['detail'] )
+    queue ``q2`` not found
+    queue ``q3`` not found
+    queue ``q1`` has 1 workers; expected 2
+    queue ``q2`` not found in worker-check; expected 1 workers
+    failed-count increased by 20; limit is 10
+    >>> list_violations( 10, expectations_data, rqinfo_data )[0]
+    {'check': 'queue_check', 'queue': 'q2', 'expected': 'present', 'actual': 'missing', 'detail': 'queue ``q2`` not found'}
+
+    Backlog rules:
+    >>> rules = {'q1': {'max_length': 100, 'max_growth_per_minute': 20, 'max_time_to_drain': 30}}
+    >>> expectations_data = {'expected_queues': [], 'expected_workers': [], 'surge_failure_limit': 10, 'queue_rules': rules}
+    >>> rqinfo_data = {'failed_count': 0, 'queues': ['q1'], 'workers_by_queue': {'q1': []}, 'queue_lengths': {'q1': 150}}
+    >>> trends = {'q1': {'growth_per_minute': 25.0, 'minutes_to_empty': None}}
+    >>> for violation in list_violations( 0, expectations_data, rqinfo_data, trends ):
+    ...     print( violation['rule'], '--', violation['detail'] )
+    max_length -- queue ``q1`` has 150 jobs; limit is 100
+    max_growth_per_minute -- queue ``q1`` grew 25.0 jobs/minute; limit is 20
+    max_time_to_drain -- queue ``q1`` is not draining (growing 25.0 jobs/minute); limit is 30 minutes to drain
+
+    Heartbeat thresholds:
+    >>> expectations_data = {'expected_queues': [], 'expected_workers': [], 'surge_failure_limit': 10, 'max_heartbeat_age_seconds': 120, 'max_job_seconds': 900}
+    >>> workers = {
+    ...     'w.1': {'queues': ['q1'], 'state': 'busy', 'heartbeat_age_seconds': 30.0, 'current_job': 'abc', 'job_seconds': 1200.0},
+    ...     'w.2': {'queues': ['q1', 'q2'], 'state': 'idle', 'heartbeat_age_seconds': 600.0, 'current_job': None, 'job_seconds': None} }
+    >>> rqinfo_data = {'failed_count': 0, 'queues': ['q1', 'q2'], 'workers_by_queue': {'q1': ['w.1', 'w.2'], 'q2': ['w.2']}, 'workers': workers}
+    >>> for violation in list_violations( 0, expectations_data, rqinfo_data ):
+    ...     print( violation['rule'], '--', violation['detail'] )
+    stuck -- worker ``w.1`` has been on job ``abc`` for 1200.0 seconds; limit is 900
+    stale -- worker ``w.2`` last heartbeat was 600.0 seconds ago; limit is 120
+
+    Sustained all-busy workers:
+    >>> expectations_data = {'expected_queues': [], 'expected_workers': [], 'surge_failure_limit': 10, 'max_busy_minutes': 15}
+    >>> rqinfo_data = {'failed_count': 0, 'queues': ['q1', 'q2'], 'workers_by_queue': {'q1': ['w.1'], 'q2': ['w.1']}}
+    >>> [ violation['detail'] for violation in list_violations( 0, expectations_data, rqinfo_data, {'q1': {'busy_minutes': 20.0}, 'q2': {'busy_minutes': 0.0}} ) ]
+    ['every worker on queue ``q1`` has been busy for 20.0 minutes; limit is 15']
+
+    Failure-ratio (`failure_ratio_min_jobs` defaults to 20):
+    >>> expectations_data = {'expected_queues': [], 'expected_workers': [], 'surge_failure_limit': 10, 'max_failure_ratio': 0.05}
+    >>> rqinfo_data = {'failed_count': 0, 'queues': ['q1', 'q2'], 'workers_by_queue': {}}
+    >>> trends = {'q1': {'succeeded': 900, 'failed': 100, 'processed': 1000, 'failure_ratio': 0.1}, 'q2': {'succeeded': 5, 'failed': 5, 'processed': 10, 'failure_ratio': 0.5}}
+    >>> [ violation['detail'] for violation in list_violations( 0, expectations_data, rqinfo_data, trends ) ]
+    ['queue ``q1`` workers failed 100 of 1000 jobs (10.0%) since the previous check; limit is 5.0%']
+
+    Adaptive failure-surge:
+    >>> expectations_data = {'expected_queues': [], 'expected_workers': [], 'surge_failure_limit': 10}
+    >>> rqinfo_data = {'failed_count': 30, 'queues': [], 'workers_by_queue': {}}
+    >>> baseline = {'source': 'hour_of_week', 'rate_per_minute': 30.0, 'mean': 2.0, 'stddev': 1.5, 'samples': 90}
+    >>> [ violation['detail'] for violation in list_violations( 0, expectations_data, rqinfo_data, failure_baseline=baseline ) ]
+    ['failed-count increased by 30 (30.0/minute); normal for this hour-of-week is 2.0 +/- 1.5/minute; limit is 8.0/minute']
+    >>> baseline = {'source': 'overall', 'rate_per_minute': 30.0, 'mean': 25.0, 'stddev': 5.0, 'samples': 900}
+    >>> list_violations( 0, expectations_data, rqinfo_data, failure_baseline=baseline )  # a busy system: 30 is normal
+    []
+    """
     assert type( previous_failed_count ) == int
     assert type( expectations ) == dict
     assert type( data_dct ) == dict
-    checks_result = {'queue_check': 'init', 'worker_check': 'init', 'failure_queue_check': 'init'}
+    violations = []
     ## queue check --------------------------------------------------
-    queue_check_flag = 'init'
+    present_queues = set( data_dct['queues'] )
     for queue in expectations['expected_queues']:
-        if queue not in data_dct['queues']:
-            log.debug( f'queue, ``{queue}``, not found in queue-check' )
-            checks_result['queue_check'] = 'FAIL'
-            queue_check_flag = 'fail'
-            break
-    if queue_check_flag == 'init':
-        checks_result['queue_check'] = 'ok'
-    log.debug( f'after queue-check, checks_result, ``{checks_result}``' )
+        if queue not in present_queues:
+            violations.append( {
+                'check': 'queue_check', 'queue': queue, 'expected': 'present', 'actual': 'missing',
+                'detail': f'queue ``{queue}`` not found' } )
     ## worker check --------------------------------------------------
-    worker_check_flag = 'init'
+    workers_by_queue = data_dct['workers_by_queue']
     for worker_dct in expectations['expected_workers']:
-        log.debug( f'checking worker_dct, ``{worker_dct}``')
         queue = worker_dct['queue']
         worker_count = worker_dct['worker_count']
-        if queue not in data_dct['workers_by_queue']:
-            log.debug( f'queue, ``{queue}``, not found in worker-check' )
-            checks_result['worker_check'] = 'FAIL'
-            worker_check_flag = 'fail'
-            break
-        if len( data_dct['workers_by_queue'][queue] ) != worker_count:
-            log.debug( f'queue, ``{queue}``, has wrong number of workers' )
-            checks_result['worker_check'] = 'FAIL'
-            worker_check_flag = 'fail'
-            break
-    if worker_check_flag == 'init':
-        checks_result['worker_check'] = 'ok'
-    log.debug( f'after worker-check, checks_result, ``{checks_result}``' )
+        if queue not in workers_by_queue:
+            violations.append( {
+                'check': 'worker_check', 'queue': queue, 'expected': worker_count, 'actual': None,
+                'detail': f'queue ``{queue}`` not found in worker-check; expected {worker_count} workers' } )
+        elif len( workers_by_queue[queue] ) != worker_count:
+            actual_count = len( workers_by_queue[queue] )
+            violations.append( {
+                'check': 'worker_check', 'queue': queue, 'expected': worker_count, 'actual': actual_count,
+                'detail': f'queue ``{queue}`` has {actual_count} workers; expected {worker_count}' } )
     ## failure-count check ------------------------------------------
     failure_increase = data_dct['failed_count'] - previous_failed_count
-    log.debug( f'failure_increase, ``{failure_increase}``' )
     surge_failure_limit = expectations['surge_failure_limit']
-    log.debug( f'surge_failure_limit, ``{surge_failure_limit}``' )
-    if failure_increase > surge_failure_limit:
-        log.debug( f'failure-increase exceeded expectation-settings-limit')
-        checks_result['failure_queue_check'] = 'FAIL'
-    else:
-        checks_result['failure_queue_check'] = 'ok'
+    if failure_baseline is not None:
+        violations.extend( list_adaptive_surge_violations(expectations, failure_increase, failure_baseline) )
+    elif failure_increase > surge_failure_limit:
+        violations.append( {
+            'check': 'failure_queue_check', 'queue': 'failed', 'expected': surge_failure_limit, 'actual': failure_increase,
+            'detail': f'failed-count increased by {failure_increase}; limit is {surge_failure_limit}' } )
+    ## backlog check ------------------------------------------------
+    queue_lengths = data_dct.get( 'queue_lengths', {} )
+    for ( queue, rules ) in expectations.get( 'queue_rules', {} ).items():
+        if queue not in queue_lengths:  # a missing queue is the queue-check's business
+            continue
+        violations.extend( list_backlog_violations(
+            queue, rules, queue_lengths[queue], (queue_trends or {}).get(queue, {}), data_dct.get('queue_wait_times', {}).get(queue)) )
+    ## saturation check ---------------------------------------------
+    for ( queue, trend ) in sorted( (queue_trends or {}).items() ):
+        max_busy_minutes = get_queue_setting( expectations, queue, 'max_busy_minutes' )
+        if max_busy_minutes is not None and trend.get( 'busy_minutes', 0 ) >= max_busy_minutes > 0:
+            violations.append( {
+                'check': 'saturation_check', 'queue': queue, 'expected': max_busy_minutes, 'actual': trend['busy_minutes'],
+                'detail': f'every worker on queue ``{queue}`` has been busy for {trend["busy_minutes"]} minutes; limit is {max_busy_minutes}' } )
+    ## failure-ratio check ------------------------------------------
+    for ( queue, trend ) in sorted( (queue_trends or {}).items() ):
+        max_failure_ratio = get_queue_setting( expectations, queue, 'max_failure_ratio' )
+        min_jobs = get_queue_setting( expectations, queue, 'failure_ratio_min_jobs' ) or DEFAULT_FAILURE_RATIO_MIN_JOBS
+        if max_failure_ratio is None or trend.get( 'failure_ratio' ) is None or trend['processed'] < min_jobs:
+            continue
+        if trend['failure_ratio'] > max_failure_ratio:
+            violations.append( {
+                'check': 'failure_ratio_check', 'queue': queue, 'expected': max_failure_ratio, 'actual': trend['failure_ratio'],
+                'detail': f'queue ``{queue}`` workers failed {trend["failed"]} of {trend["processed"]} jobs ({trend["failure_ratio"]:.1%}) since the previous check; limit is {max_failure_ratio:.1%}' } )
+    ## heartbeat check ----------------------------------------------
+    if uses_heartbeat_check( expectations ):
+        if 'workers' in data_dct:
+            violations.extend( list_heartbeat_violations(expectations, data_dct['workers']) )
+        else:
+            log.info( 'heartbeat thresholds set, but worker details need direct redis reads (`QCHKR__REDIS_URL`); skipping heartbeat check' )
+    if log.isEnabledFor( logging.DEBUG ):
+        log.debug( f'violations, ``{violations}``' )
+    return violations
+    # end def list_violations()
+
+
+def list_backlog_violations( queue, rules, length, trend, wait_times=None ):
+    """ Returns violations of one queue's backlog rules: `max_length` (jobs), `max_growth_per_minute` (jobs),
+          and `max_time_to_drain` (minutes; a queue that's steady or growing with jobs waiting isn't draining, so exceeds any limit);
+          and, where wait-times were sampled (direct redis reads), `max_wait_seconds` (the oldest job's wait)
+          and `max_p95_wait_seconds`.
+        Called by list_violations()
+    >>> wait_times = {'sampled': 11, 'p50_seconds': 40.0, 'p95_seconds': 95.0, 'max_seconds': 310.0}
+    >>> [ violation['detail'] for violation in list_backlog_violations( 'q1', {'max_wait_seconds': 300, 'max_p95_wait_seconds': 120}, 50, {}, wait_times ) ]
+    ['queue ``q1`` oldest job has waited 310.0 seconds; limit is 300']
+    >>> stalled = {'growth_per_minute': 0.0, 'minutes_to_empty': None}
+    >>> [ violation['detail'] for violation in list_backlog_violations( 'q1', {'max_time_to_drain': 30}, 500, stalled ) ]
+    ['queue ``q1`` is not draining (steady at 500 jobs); limit is 30 minutes to drain']
+    """
+    violations = []
+    growth_per_minute = trend.get( 'growth_per_minute' )
+    if 'max_length' in rules and length > rules['max_length']:
+        violations.append( {
+            'check': 'backlog_check', 'queue': queue, 'rule': 'max_length', 'expected': rules['max_length'], 'actual': length,
+            'detail': f'queue ``{queue}`` has {length} jobs; limit is {rules["max_length"]}' } )
+    if 'max_growth_per_minute' in rules and growth_per_minute is not None and growth_per_minute > rules['max_growth_per_minute']:
+        violations.append( {
+            'check': 'backlog_check', 'queue': queue, 'rule': 'max_growth_per_minute', 'expected': rules['max_growth_per_minute'], 'actual': growth_per_minute,
+            'detail': f'queue ``{queue}`` grew {growth_per_minute} jobs/minute; limit is {rules["max_growth_per_minute"]}' } )
+    if 'max_time_to_drain' in rules:
+        minutes_to_empty = trend.get( 'minutes_to_empty' )
+        if minutes_to_empty is None and length > 0 and growth_per_minute is not None and growth_per_minute >= 0:
+            movement = f'growing {growth_per_minute} jobs/minute' if growth_per_minute > 0 else f'steady at {length} jobs'
+            violations.append( {
+                'check': 'backlog_check', 'queue': queue, 'rule': 'max_time_to_drain', 'expected': rules['max_time_to_drain'], 'actual': None,
+                'detail': f'queue ``{queue}`` is not draining ({movement}); limit is {rules["max_time_to_drain"]} minutes to drain' } )
+        elif minutes_to_empty is not None and minutes_to_empty > rules['max_time_to_drain']:
+            violations.append( {
+                'check': 'backlog_check', 'queue': queue, 'rule': 'max_time_to_drain', 'expected': rules['max_time_to_drain'], 'actual': minutes_to_empty,
+                'detail': f'queue ``{queue}`` needs about {minutes_to_empty} minutes to drain; limit is {rules["max_time_to_drain"]}' } )
+    if wait_times:
+        if 'max_wait_seconds' in rules and wait_times['max_seconds'] > rules['max_wait_seconds']:
+            violations.append( {
+                'check': 'backlog_check', 'queue': queue, 'rule': 'max_wait_seconds', 'expected': rules['max_wait_seconds'], 'actual': wait_times['max_seconds'],
+                'detail': f'queue ``{queue}`` oldest job has waited {wait_times["max_seconds"]} seconds; limit is {rules["max_wait_seconds"]}' } )
+        if 'max_p95_wait_seconds' in rules and wait_times['p95_seconds'] > rules['max_p95_wait_seconds']:
+            violations.append( {
+                'check': 'backlog_check', 'queue': queue, 'rule': 'max_p95_wait_seconds', 'expected': rules['max_p95_wait_seconds'], 'actual': wait_times['p95_seconds'],
+                'detail': f'queue ``{queue}`` 95th-percentile wait is {wait_times["p95_seconds"]} seconds; limit is {rules["max_p95_wait_seconds"]}' } )
+    return violations
+
+
+def uses_heartbeat_check( expectations ):
+    """ Returns True if the expectations set a heartbeat-age or job-duration threshold.
+        Called by list_violations() and summarize_violations() """
+    return bool( expectations.get('max_heartbeat_age_seconds') or expectations.get('max_job_seconds') )
+
+
+def list_adaptive_surge_violations( expectations, failure_increase, failure_baseline ):
+    """ Returns a failure-surge violation if the failure-rate is over `surge_sigma` standard deviations above the baseline's mean
+          (and at least `surge_min_failures` jobs failed).
+        Called by list_violations() """
+    surge_sigma = expectations.get( 'surge_sigma', DEFAULT_SURGE_SIGMA )
+    surge_min_failures = expectations.get( 'surge_min_failures', DEFAULT_SURGE_MIN_FAILURES )
+    rate_limit = round( failure_baseline['mean'] + surge_sigma * failure_baseline['stddev'], 2 )
+    if failure_baseline['rate_per_minute'] <= rate_limit or failure_increase < surge_min_failures:
+        return []
+    normal = f'{round(failure_baseline["mean"], 2)} +/- {round(failure_baseline["stddev"], 2)}/minute'
+    return [ {
+        'check': 'failure_queue_check', 'queue': 'failed', 'expected': rate_limit, 'actual': failure_baseline['rate_per_minute'],
+        'detail': ( f'failed-count increased by {failure_increase} ({failure_baseline["rate_per_minute"]}/minute); '
+                    f'normal {BASELINE_SOURCE_LABELS[failure_baseline["source"]]} is {normal}; limit is {rate_limit}/minute' ) } ]
+
+
+def list_heartbeat_violations( expectations, workers ):
+    """ Returns violations for workers whose heartbeat is older than `max_heartbeat_age_seconds` (probably hung or dead),
+          or that have been on their current job longer than `max_job_seconds` (probably stuck).
+        Called by list_violations() """
+    max_heartbeat_age = expectations.get( 'max_heartbeat_age_seconds' )
+    max_job_seconds = expectations.get( 'max_job_seconds' )
+    violations = []
+    for ( worker_name, worker ) in sorted( workers.items() ):
+        queue = ','.join( worker['queues'] )
+        heartbeat_age = worker.get( 'heartbeat_age_seconds' )
+        if max_heartbeat_age and heartbeat_age is not None and heartbeat_age > max_heartbeat_age:
+            violations.append( {
+                'check': 'heartbeat_check', 'queue': queue, 'worker': worker_name, 'rule': 'stale', 'expected': max_heartbeat_age, 'actual': heartbeat_age,
+                'detail': f'worker ``{worker_name}`` last heartbeat was {heartbeat_age} seconds ago; limit is {max_heartbeat_age}' } )
+        job_seconds = worker.get( 'job_seconds' )
+        if max_job_seconds and job_seconds is not None and job_seconds > max_job_seconds:
+            violations.append( {
+                'check': 'heartbeat_check', 'queue': queue, 'worker': worker_name, 'rule': 'stuck', 'expected': max_job_seconds, 'actual': job_seconds,
+                'detail': f'worker ``{worker_name}`` has been on job ``{worker["current_job"]}`` for {job_seconds} seconds; limit is {max_job_seconds}' } )
+    return violations
+
+
+def summarize_violations( violations, expectations=None ):
+    """ Returns the per-check ok/FAIL dict for a list of violations.
+        - `backlog_check` is included only when the expectations have `queue_rules`;
+          `saturation_check` only when they set `max_busy_minutes` (top-level or in `queue_rules`);
+          `failure_ratio_check` only when they set `max_failure_ratio` (likewise);
+          `heartbeat_check` only when they set a heartbeat-age or job-duration threshold.
+        Called by evaluate_qdata() and check_rqinfo_data()
+    >>> summarize_violations( [] )
+    {'queue_check': 'ok', 'worker_check': 'ok', 'failure_queue_check': 'ok'}
+    >>> summarize_violations( [{'check': 'worker_check'}, {'check': 'worker_check'}] )
+    {'queue_check': 'ok', 'worker_check': 'FAIL', 'failure_queue_check': 'ok'}
+    >>> summarize_violations( [], {'queue_rules': {'q1': {'max_length': 10}}} )
+    {'queue_check': 'ok', 'worker_check': 'ok', 'failure_queue_check': 'ok', 'backlog_check': 'ok'}
+    """
+    checks_result = dict( OK_EVALUATION )
+    if expectations and expectations.get( 'queue_rules' ):
+        checks_result['backlog_check'] = 'ok'
+    if expectations and has_queue_setting( expectations, 'max_busy_minutes' ):
+        checks_result['saturation_check'] = 'ok'
+    if expectations and has_queue_setting( expectations, 'max_failure_ratio' ):
+        checks_result['failure_ratio_check'] = 'ok'
+    if expectations and uses_heartbeat_check( expectations ):
+        checks_result['heartbeat_check'] = 'ok'
+    for violation in violations:
+        checks_result[violation['check']] = 'FAIL'
     log.debug( f'checks_result, ``{checks_result}``' )
     return checks_result
-    # end def evaluate_qdata()
 
 
-def build_email_message( previous_failure_count, expectations_dct, evaluation_dct, data_dct ):
+def build_email_message(
+        previous_failure_count, expectations_dct, evaluation_dct, data_dct, violations=None, notifications=None, queue_rates=None, failure_groups=None ):
     """ Assembles email message.
-        Called by run_code() """
+        Called by run_checks() and build_fleet_email_message() """
+    import pprint
     assert type(evaluation_dct) == dict
     assert type(data_dct) == dict
+    rate_lines = '\n'.join(
+        f'- {queue_name}: length {rates["length"]}; growth/min {rates["growth_per_minute"]}; minutes-to-empty {rates["minutes_to_empty"]}'
+        for ( queue_name, rates ) in (queue_rates or {}).items() if rates['growth_per_minute'] or rates['length'] ) or '(no queued jobs)'
+    violation_lines = '\n'.join( f'- {violation["detail"]}' for violation in (violations or []) ) or '(none listed)'
+    notification_lines = '\n'.join( f'- {notification["kind"].upper()}: {notification["detail"]}' for notification in (notifications or []) ) or '(none listed)'
+    failure_group_lines = format_failure_groups( failure_groups )
     msg = f'''
 TIME-STAMP ----------------------------------------------------------
 {datetime.datetime.now()}
@@ -268,12 +2574,24 @@ TIME-STAMP ----------------------------------------------------------
 CHECK-RESULT --------------------------------------------------------
 {repr(evaluation_dct)}
 
+ALERT CHANGES -------------------------------------------------------
+{notification_lines}
+
+VIOLATIONS ----------------------------------------------------------
+{violation_lines}
+
+NEW FAILED JOBS (since previous check) ------------------------------
+{failure_group_lines}
+
 EXPECTATIONS SETTINGS -----------------------------------------------
 {pprint.pformat(expectations_dct)}
 
 ACTUAL RQINFO-DATA -------------------------------------------------- 
 {pprint.pformat(data_dct)}
 
+QUEUE RATES (since previous check) ----------------------------------
+{rate_lines}
+
 PREVIOUS RQINFO-DATA FAILURE-COUNT ----------------------------------
 {previous_failure_count}
 
@@ -284,33 +2602,402 @@ PREVIOUS RQINFO-DATA FAILURE-COUNT ----------------------------------
     return msg
 
 
-def send_email( message ):
-    """ Sends mail; generates exception which cron-job should email to crontab owner on sendmail failure.
-        Called by run_code() """
-    assert type(message) == str, type(message)
-    log.debug( f'message, ``{message}``' )
+def deliver_alert( message ):
+    """ Queues the message in the durable outbox, then has the outbox delivered:
+          by the background mail-sender if one is running (daemon and exporter modes), otherwise right away.
+        Called by send_alerts() and flush_digest() """
+    enqueue_outbox_message( OUTBOX_DB_PATH, message, int(time.time()) )
+    if mail_sender is not None:
+        mail_sender.wake()
+    else:
+        send_pending_email( OUTBOX_DB_PATH )
+    return
+
+
+def retry_pending_email():
+    """ In run-once mode, re-tries sending messages left in the outbox by an earlier failed run, even when there's no new alert.
+        (In daemon mode the background mail-sender does this.)
+        Called by send_alerts() """
+    if mail_sender is not None or not os.path.exists( OUTBOX_DB_PATH ):
+        return
+    if count_pending_outbox_messages( OUTBOX_DB_PATH ) > 0:
+        with timed_stage( 'email_send' ):
+            send_pending_email( OUTBOX_DB_PATH )
+    return
+
+
+def send_pending_email( outbox_db_path ):
+    """ Sends every pending outbox message over one smtp session.
+        Generates exception which cron-job should email to crontab owner on sendmail failure;
+          unsent messages stay in the outbox, and go out with the next run's mail.
+        Called by deliver_alert() """
+    import smtplib
+    email_settings = get_email_settings()
+    try:
+        with smtplib.SMTP( email_settings['host'], email_settings['port'] ) as s:
+            flush_outbox( outbox_db_path, s, email_settings )
+    except Exception as e:
+        err = repr( e )
+        log.exception( f'Problem sending queue-checker mail, ``{err}``' )
+        raise Exception( err )
+    return
+
+
+def get_email_settings():
+    """ Returns the email settings from envars.
+        Called by send_pending_email() and MailSender """
     EMAIL_HOST = os.environ['QCHKR__EMAIL_HOST']
     EMAIL_PORT = int( os.environ['QCHKR__EMAIL_HOST_PORT'] )  
     # EMAIL_FROM = os.environ['QCHKR__EMAIL_FROM']
     EMAIL_FROM = 'donotreply__rq_queue_checker@brown.edu'
     EMAIL_RECIPIENTS = json.loads( os.environ['QCHKR__EMAIL_RECIPIENTS_JSON'] )
+    return { 'host': EMAIL_HOST, 'port': EMAIL_PORT, 'from': EMAIL_FROM, 'recipients': EMAIL_RECIPIENTS }
+
+
+def build_mime_message( message, email_settings, message_key ):
+    """ Wraps the message-text in a MIMEText with subject, from, to, and a Message-ID from the outbox dedupe-key (unique to each queued message),
+          so a message re-sent after an interrupted delivery can be recognized as a duplicate.
+        Called by flush_outbox() """
+    import socket
+    from email.mime.text import MIMEText
     HOST = socket.gethostname()
-    try:
-        s = smtplib.SMTP( EMAIL_HOST, EMAIL_PORT )
-        body = message
-        eml = MIMEText( f'{body}' )
-        eml['Subject'] = f'queue-checker alert from ``{HOST.upper()}``'
-        eml['From'] = EMAIL_FROM
-        eml['To'] = ';'.join( EMAIL_RECIPIENTS )
-        s.sendmail( EMAIL_FROM, EMAIL_RECIPIENTS, eml.as_string())
-    except Exception as e:
-        err = repr( e )
-        log.exception( f'Problem sending queue-checker mail, ``{err}``' )
-        raise Exception( err )
+    eml = MIMEText( f'{message}' )
+    eml['Subject'] = f'queue-checker alert from ``{HOST.upper()}``'
+    eml['From'] = email_settings['from']
+    eml['To'] = ';'.join( email_settings['recipients'] )
+    eml['Message-ID'] = f'<qchkr-{message_key}@{HOST}>'
+    return eml
+
+
+## durable outbox ---------------------------------------------------
+##
+## Alert messages are written to a sqlite outbox before any delivery attempt, and marked sent only after the relay accepts them,
+##   so an smtp outage delays alerts rather than losing them (at-least-once delivery).
+## Re-queueing a message identical to one still pending is a no-op; once sent, the same text can be queued again (a repeated reminder or digest).
+## Each queued message's `dedupe_key` starts with a hash of its text (for that pending-check), then adds its queueing-time and a random suffix;
+##   the key becomes the Message-ID, so a re-send after a crash mid-delivery is recognizable, while a later repeat is a new message.
+
+OUTBOX_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    dedupe_key TEXT NOT NULL UNIQUE,
+    created_ts INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    sent_ts INTEGER );
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox ( sent_ts, id );
+'''
+OUTBOX_SENT_RETENTION_SECONDS = 7 * 24 * 60 * 60
+OUTBOX_TEXT_HASH_LENGTH = 32  # hex characters of the text-hash that start each dedupe_key
+
+
+def open_outbox( db_path ):
+    """ Opens (creating if necessary) the outbox database; returns a sqlite3 connection.
+        Called by the outbox functions. """
+    db_dir_path = os.path.dirname( db_path )
+    if db_dir_path:
+        os.makedirs( db_dir_path, exist_ok=True )
+    outbox_conn = sqlite3.connect( db_path, timeout=30 )
+    outbox_conn.execute( 'PRAGMA journal_mode=WAL' )
+    outbox_conn.executescript( OUTBOX_SCHEMA )
+    return outbox_conn
+
+
+def enqueue_outbox_message( db_path, message, now_ts ):
+    """ Durably adds a message to the outbox, unless an identical message is still pending there.
+        Called by deliver_alert() """
+    import hashlib
+    assert type(message) == str, type(message)
+    text_hash = hashlib.sha256( message.encode('utf-8') ).hexdigest()[:OUTBOX_TEXT_HASH_LENGTH]
+    dedupe_key = f'{text_hash}.{now_ts}.{os.urandom(4).hex()}'
+    with closing( open_outbox(db_path) ) as outbox_conn, outbox_conn:
+        outbox_conn.execute( 'BEGIN IMMEDIATE' )  # so concurrent runs can't both queue the same message
+        already_pending = outbox_conn.execute(
+            'SELECT 1 FROM outbox WHERE sent_ts IS NULL AND substr( dedupe_key, 1, ? ) = ? LIMIT 1', (OUTBOX_TEXT_HASH_LENGTH, text_hash) ).fetchone()
+        if already_pending:
+            log.debug( f'identical message already pending in outbox; text_hash, ``{text_hash}``' )
+            return
+        outbox_conn.execute( 'INSERT INTO outbox ( dedupe_key, created_ts, message ) VALUES ( ?, ?, ? )', (dedupe_key, now_ts, message) )
+    log.debug( f'message queued in outbox; dedupe_key, ``{dedupe_key}``' )
+    return
+
+
+def flush_outbox( db_path, smtp_connection, email_settings, batch_size=100 ):
+    """
+    Sends pending outbox messages, oldest first, over the given smtp connection; marks each sent as soon as the relay accepts it.
+    Returns the number sent. On a delivery problem, records it against the message and raises; the rest stay pending.
+    Called by send_pending_email() and MailSender
+
+    >>> import tempfile
+    >>> class RecordingSMTP:
+    ...     def sendmail( self, from_addr, to_addrs, msg ):
+    ...         print( 'sent', msg.split('\\n')[-1] )
+    >>> settings = {'host': 'relay', 'port': 25, 'from': 'a@example.edu', 'recipients': ['b@example.edu']}
+    >>> with tempfile.TemporaryDirectory() as temp_dir:
+    ...     db_path = f'{temp_dir}/outbox.sqlite3'
+    ...     for text in ( 'first', 'second', 'first' ):  # the repeat is deduped, since the first is still pending
+    ...         enqueue_outbox_message( db_path, text, now_ts=1000 )
+    ...     flush_outbox( db_path, RecordingSMTP(), settings )
+    ...     flush_outbox( db_path, RecordingSMTP(), settings )  # nothing left pending
+    ...     enqueue_outbox_message( db_path, 'first', now_ts=1060 )  # once sent, the same text goes out again
+    ...     flush_outbox( db_path, RecordingSMTP(), settings )
+    sent first
+    sent second
+    2
+    0
+    sent first
+    1
+    """
+    sent_count = 0
+    with closing( open_outbox(db_path) ) as outbox_conn:
+        pending = outbox_conn.execute(
+            'SELECT id, dedupe_key, message FROM outbox WHERE sent_ts IS NULL ORDER BY id LIMIT ?', (batch_size,) ).fetchall()
+        for ( message_id, dedupe_key, message ) in pending:
+            try:
+                eml = build_mime_message( message, email_settings, dedupe_key )
+                smtp_connection.sendmail( email_settings['from'], email_settings['recipients'], eml.as_string() )
+            except Exception as e:
+                with outbox_conn:
+                    outbox_conn.execute( 'UPDATE outbox SET attempts = attempts + 1, last_error = ? WHERE id = ?', (repr(e), message_id) )
+                raise
+            with outbox_conn:
+                outbox_conn.execute( 'UPDATE outbox SET attempts = attempts + 1, sent_ts = ? WHERE id = ?', (int(time.time()), message_id) )
+            sent_count += 1
+        with outbox_conn:
+            outbox_conn.execute( 'DELETE FROM outbox WHERE sent_ts < ?', (int(time.time()) - OUTBOX_SENT_RETENTION_SECONDS,) )
+    log.debug( f'outbox messages sent, ``{sent_count}``' )
+    return sent_count
+
+
+def count_pending_outbox_messages( db_path ):
+    """ Returns the number of unsent outbox messages.
+        Called by MailSender and retry_pending_email() """
+    with closing( open_outbox(db_path) ) as outbox_conn:
+        ( pending_count, ) = outbox_conn.execute( 'SELECT COUNT(*) FROM outbox WHERE sent_ts IS NULL' ).fetchone()
+    return pending_count
+
+
+## background mail-sender -------------------------------------------
+
+mail_sender = None  # a running MailSender, in daemon and exporter modes
+
+
+class MailSender:
+    """
+    Flushes the outbox on a background thread, so a slow or down mail-relay never stalls the checking loop.
+    - Woken by each new message; also retries any still-pending messages every `idle_seconds`.
+    - Each flush sends every pending message over one smtp connection, which is reused across flushes:
+        checked with NOOP before use, re-opened if dropped, and closed when there's been nothing to send for `idle_seconds`.
+    - A failed flush is retried up to `max_attempts` times, with exponential backoff capped at `max_backoff_seconds`;
+        messages still unsent then stay in the outbox for the next wake-up.
+    Started by start_mail_sender(); used via deliver_alert().
+
+    Example, with a relay that drops the first attempt:
+    >>> import tempfile
+    >>> class FlakySMTP:
+    ...     attempts = 0
+    ...     def __init__( self, host, port ):
+    ...         FlakySMTP.attempts += 1
+    ...         if FlakySMTP.attempts == 1:
+    ...             raise ConnectionRefusedError( 'relay restarting' )
+    ...     def noop( self ):
+    ...         return ( 250, b'ok' )
+    ...     def sendmail( self, from_addr, to_addrs, msg ):
+    ...         print( f'sent to {to_addrs}' )
+    ...     def quit( self ):
+    ...         pass
+    >>> settings = {'host': 'relay', 'port': 25, 'from': 'a@example.edu', 'recipients': ['b@example.edu']}
+    >>> temp_dir = tempfile.TemporaryDirectory()
+    >>> sender = MailSender( f'{temp_dir.name}/outbox.sqlite3', smtp_factory=FlakySMTP, email_settings=settings, backoff_seconds=0.01 )
+    >>> enqueue_outbox_message( sender.outbox_db_path, 'first', now_ts=1000 )
+    >>> enqueue_outbox_message( sender.outbox_db_path, 'second', now_ts=1000 )
+    >>> sender.start(); sender.wake()
+    >>> sender.stop( timeout=5 )
+    sent to ['b@example.edu']
+    sent to ['b@example.edu']
+    >>> FlakySMTP.attempts  # one failed connect, then one connection for both messages
+    2
+    >>> temp_dir.cleanup()
+    """
+
+    STOP = object()  # queued by stop() to end the thread after a final flush
+
+    def __init__( self, outbox_db_path, smtp_factory=None, email_settings=None, max_attempts=5, backoff_seconds=2.0, max_backoff_seconds=60.0, idle_seconds=60.0 ):
+        if smtp_factory is None:
+            import smtplib
+            smtp_factory = smtplib.SMTP
+        self.outbox_db_path = outbox_db_path
+        self.smtp_factory = smtp_factory
+        self.email_settings = email_settings
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.idle_seconds = idle_seconds
+        self.wake_ups = Queue()
+        self.connection = None
+        self.thread = threading.Thread( target=self.run, name='mail-sender', daemon=True )
+
+    def start( self ):
+        self.thread.start()
+
+    def wake( self ):
+        self.wake_ups.put( True )
+
+    def stop( self, timeout ):
+        """ Makes a final flush of the outbox (for up to `timeout` seconds), then stops the thread. """
+        self.wake_ups.put( self.STOP )
+        self.thread.join( timeout )
+        if self.thread.is_alive():
+            log.warning( f'mail-sender still busy after ``{timeout}`` seconds; undelivered messages stay in the outbox' )
+
+    def run( self ):
+        while True:
+            try:
+                signal_value = self.wake_ups.get( timeout=self.idle_seconds )
+            except Empty:
+                if count_pending_outbox_messages( self.outbox_db_path ) == 0:
+                    self.close_connection()
+                    continue
+                signal_value = True  # retry messages left pending by an earlier failure
+            self.flush_with_retries()
+            if signal_value is self.STOP:
+                break
+        self.close_connection()
+
+    def flush_with_retries( self ):
+        if count_pending_outbox_messages( self.outbox_db_path ) == 0:
+            return True
+        for attempt in range( 1, self.max_attempts + 1 ):
+            try:
+                email_settings = self.email_settings or get_email_settings()
+                while flush_outbox( self.outbox_db_path, self.get_connection(email_settings), email_settings ):
+                    pass
+                return True
+            except Exception as e:
+                self.close_connection()
+                if attempt == self.max_attempts:
+                    log.exception( f'giving up on queue-checker mail for now after ``{attempt}`` attempts; err, ``{repr(e)}``; messages stay in the outbox' )
+                    return False
+                delay = min( self.backoff_seconds * (2 ** (attempt - 1)), self.max_backoff_seconds )
+                log.warning( f'problem sending queue-checker mail, attempt ``{attempt}``; err, ``{repr(e)}``; retrying in ``{delay}`` seconds' )
+                time.sleep( delay )
+
+    def get_connection( self, email_settings ):
+        if self.connection is not None:
+            try:
+                if self.connection.noop()[0] == 250:
+                    return self.connection
+            except Exception as e:
+                log.debug( f'smtp connection went stale; err, ``{repr(e)}``' )
+            self.close_connection()
+        self.connection = self.smtp_factory( email_settings['host'], email_settings['port'] )
+        return self.connection
+
+    def close_connection( self ):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except Exception:
+                pass
+            self.connection = None
+
+
+def start_mail_sender():
+    """ Starts the background mail-sender used by deliver_alert(); it begins by sending anything left in the outbox.
+        Called by run_daemon() """
+    global mail_sender
+    mail_sender = MailSender( OUTBOX_DB_PATH )
+    mail_sender.start()
+    mail_sender.wake()
     return
 
 
+def stop_mail_sender( timeout=30 ):
+    """ Makes a final outbox-flush, and stops the background mail-sender; later alerts are sent synchronously.
+        Called by run_daemon() """
+    global mail_sender
+    if mail_sender is not None:
+        mail_sender.stop( timeout )
+        mail_sender = None
+    return
+
+
+## in-process redis stand-in (for doctests) ------------------------
+
+
+class LocalRedis:
+    """ Minimal in-process stand-in for the part of the redis-py api the collectors use.
+        Holds data in plain sets, lists and dicts; `execute_count` counts pipeline round-trips. """
+
+    def __init__( self, sets=None, lists=None, hashes=None ):
+        self.sets = sets or {}
+        self.lists = lists or {}
+        self.hashes = hashes or {}
+        self.execute_count = 0
+
+    def smembers( self, key ):
+        return set( self.sets.get(key, set()) )
+
+    def llen( self, key ):
+        return len( self.lists.get(key, []) )
+
+    def lrange( self, key, start, end ):
+        items = self.lists.get( key, [] )
+        end = len(items) if end == -1 else end + 1
+        return items[start:end]
+
+    def lindex( self, key, index ):
+        items = self.lists.get( key, [] )
+        return items[index] if -len(items) <= index < len(items) else None
+
+    def hget( self, key, field ):
+        return self.hashes.get( key, {} ).get( field )
+
+    def hmget( self, key, *fields ):
+        if len(fields) == 1 and type(fields[0]) in (list, tuple):
+            fields = fields[0]
+        return [ self.hget(key, field) for field in fields ]
+
+    def pipeline( self, transaction=True ):
+        return LocalRedisPipeline( self )
+
+
+class LocalRedisPipeline:
+    """ Queues LocalRedis calls until execute(), like a redis-py pipeline. """
+
+    def __init__( self, conn ):
+        self.conn = conn
+        self.calls = []
+
+    def __getattr__( self, name ):
+        method = getattr( self.conn, name )
+        def queue_call( *args, **kwargs ):
+            self.calls.append( (method, args, kwargs) )
+            return self
+        return queue_call
+
+    def execute( self ):
+        self.conn.execute_count += 1
+        results = [ method(*args, **kwargs) for (method, args, kwargs) in self.calls ]
+        self.calls = []
+        return results
+
+
 ## dunder-main ------------------------------------------------------
 
 if __name__ == '__main__':
-    run_code()
+    import argparse
+    parser = argparse.ArgumentParser( description='Checks rq queues and workers against expectations.' )
+    parser.add_argument( '--daemon', action='store_true', help='keep running, checking every `--interval` seconds' )
+    parser.add_argument( '--interval', type=float, default=60, help='seconds between daemon-mode checks (default 60)' )
+    parser.add_argument( '--exporter', action='store_true', help='daemon mode, also serving prometheus metrics over http' )
+    parser.add_argument( '--bind', default='127.0.0.1', help='exporter bind-address (default 127.0.0.1)' )
+    parser.add_argument( '--port', type=int, default=9478, help='exporter port (default 9478)' )
+    args = parser.parse_args()
+    if args.exporter:
+        run_exporter( args.interval, args.bind, args.port )
+    elif args.daemon:
+        run_daemon( args.interval )
+    else:
+        run_code()